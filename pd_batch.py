@@ -0,0 +1,248 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from pd_completion import OPENAI_CHAT_ENDPOINT, CompletionClient, build_request_data
+from pd_validator import rank_candidates
+from pd_cache import ResponseCache
+from pd_retrieval import RetrievalIndex
+from pd_resources import random_prompts
+from pd_metrics import metrics, profiling
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RESET_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+RESET_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# Parse OpenAI reset durations such as "20ms", "1s" or "6m0s" into seconds
+def parse_reset(value):
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        return sum(float(amount) * RESET_UNITS[unit] for amount, unit in RESET_RE.findall(value))
+
+# Shared across all workers: pauses every request until the server says the
+# request or token budget has reset, and optionally spaces requests out to a
+# fixed requests-per-minute rate
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, min_remaining_tokens=0):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self.min_remaining_tokens = min_remaining_tokens
+        self.blocked_until = 0.0
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            wait = max(self.blocked_until, self.next_slot) - now
+            if wait <= 0:
+                self.next_slot = now + self.interval
+                return
+            await asyncio.sleep(wait)
+
+    def block_for(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None and int(remaining_requests) <= 0:
+            self.block_for(parse_reset(headers.get("x-ratelimit-reset-requests")))
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None and int(remaining_tokens) <= self.min_remaining_tokens:
+            self.block_for(parse_reset(headers.get("x-ratelimit-reset-tokens")))
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            self.block_for(parse_reset(retry_after))
+
+def slugify(text, length=40):
+    slug = re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+    return slug[:length].rstrip("-") or "patch"
+
+# Claim a filename that no other worker (or earlier run) is using
+def open_unique(output_dir, stem):
+    for attempt in range(1000):
+        suffix = f"-{attempt}" if attempt else ""
+        path = os.path.join(output_dir, f"{stem}{suffix}.pd")
+        try:
+            return path, os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), "w")
+        except FileExistsError:
+            continue
+    raise FileExistsError(f"No free filename for {stem} in {output_dir}")
+
+class BatchGenerator:
+    def __init__(self, api_key, output_dir, endpoint=OPENAI_CHAT_ENDPOINT, concurrency=8, temperature=0.5,
+                 max_retries=5, backoff=1.0, requests_per_minute=None, client=None, cache=None,
+                 retrieval_index=None, examples=3, candidates=1):
+        self.output_dir = output_dir
+        self.cache = cache
+        self.retrieval_index = retrieval_index
+        self.examples = examples
+        self.candidates = candidates
+        # Size the connection pool to the concurrency so no worker waits for a socket
+        self.client = client or CompletionClient(api_key, endpoint, pool_size=concurrency)
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = None
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.temperature = temperature
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    async def request(self, data):
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            try:
+                response = await asyncio.get_running_loop().run_in_executor(self.executor, self.client.post, data)
+            except self.client.transport_errors as error:
+                message = str(error)
+            else:
+                self.rate_limiter.update(response.headers)
+                if response.status_code == 200:
+                    try:
+                        return response.json(), None
+                    except ValueError:
+                        return None, f"Invalid JSON in response: {response.text[:200]}"
+                message = f"{response.status_code} - {response.text[:200]}"
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return None, message
+            if attempt < self.max_retries:
+                # Exponential backoff with full jitter so workers do not retry in lockstep
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        return None, message
+
+    # Generate one prompt and append its result line. Anything that goes wrong
+    # with this prompt is recorded as its error rather than stopping the batch
+    async def generate(self, index, prompt, results_file):
+        started = time.monotonic()
+        try:
+            result = await self.generate_patch(index, prompt)
+        except Exception as error:
+            result = {"index": index, "prompt": prompt, "seconds": round(time.monotonic() - started, 3),
+                      "error": f"{type(error).__name__}: {error}"}
+        # Results stream to disk as each generation finishes, in completion order
+        results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        results_file.flush()
+        return result
+
+    async def generate_patch(self, index, prompt):
+        examples = self.retrieval_index.examples(prompt, self.examples) if self.retrieval_index and self.examples else ()
+        data = build_request_data(prompt, self.temperature, n=self.candidates, examples=examples)
+        started = time.monotonic()
+        cached = self.cache.get(data) if self.cache is not None else None
+        if cached:
+            body, error = {"choices": [{"index": index, "message": {"content": text}} for index, text in enumerate(cached)]}, None
+        else:
+            async with self.semaphore:
+                body, error = await self.request(data)
+        result = {"index": index, "prompt": prompt, "seconds": round(time.monotonic() - started, 3), "cached": bool(cached)}
+        if error is None and not body.get("choices"):
+            error = "No choices in response"
+        if error is None:
+            choices = sorted(body["choices"], key=lambda choice: choice.get("index", 0))
+            ranked = rank_candidates([choice["message"]["content"] for choice in choices])
+            _, winner, validation = ranked[0]
+            if validation.ok and self.cache is not None and not cached:
+                self.cache.put(data, [candidate.text for _, _, candidate in ranked if candidate.ok])
+            result["valid"] = validation.ok
+            result["errors"] = validation.errors
+            result["repairs"] = validation.repairs
+            path, file = open_unique(self.output_dir, f"{index:05d}-{slugify(prompt)}")
+            with file:
+                file.write(validation.text)
+            result["path"] = path
+            if len(ranked) > 1:
+                result["candidate"] = winner
+                result["scores"] = [round(candidate_score, 2) for candidate_score, _, _ in ranked]
+                alternates = []
+                for _, _, candidate in ranked[1:]:
+                    if candidate.ok:
+                        alternate_path, file = open_unique(self.output_dir, f"{index:05d}-{slugify(prompt)}-alt{len(alternates) + 1}")
+                        with file:
+                            file.write(candidate.text)
+                        alternates.append(alternate_path)
+                result["alternates"] = alternates
+            result["usage"] = body.get("usage")
+        else:
+            result["error"] = error
+        return result
+
+    async def run(self, prompts, results_path):
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Each request blocks a thread in client.post; the default executor caps
+        # threads at min(32, cpu_count + 4), which would cap the concurrency too
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            with open(results_path, "a", encoding="utf-8") as results_file:
+                tasks = [self.generate(index, prompt, results_file) for index, prompt in enumerate(prompts)]
+                return await asyncio.gather(*tasks)
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+
+def read_prompts(path):
+    file = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with file:
+        return [line.strip() for line in file if line.strip()]
+
+def sample_random_prompts(count):
+    terms = random_prompts()
+    return [random.choice(terms) for _ in range(count)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Pure Data patches without the GUI")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--prompts", help="File with one prompt per line, or - for stdin")
+    source.add_argument("--random", type=int, metavar="N", help="Sample N prompts from randomPrompts.json")
+    parser.add_argument("--output-dir", default=os.path.join(os.path.expanduser("~"), "Documents", "PureDataGPTpatches", "batch"))
+    parser.add_argument("--results", default=None, help="JSONL file for per-prompt results (default: <output-dir>/results.jsonl)")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY", ""))
+    parser.add_argument("--endpoint", default=OPENAI_CHAT_ENDPOINT)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--temperature", type=float, default=0.5)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--requests-per-minute", type=float, default=None)
+    parser.add_argument("--retrieval-index", default=None, help="Index directory built by pd_retrieval.py for few-shot examples")
+    parser.add_argument("--examples", type=int, default=3, help="Few-shot examples per prompt when --retrieval-index is set")
+    parser.add_argument("--candidates", type=int, default=1, help="Candidates requested per prompt; the best-scoring one is kept")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the API instead of reusing cached patches")
+    parser.add_argument("--cache-deterministic-only", action="store_true", help="Only cache temperature-0 requests")
+    parser.add_argument("--metrics", default=None, help="Write stage timings and counters here (.prom for Prometheus text, else JSON)")
+    parser.add_argument("--profile", choices=["cprofile", "py-spy"], default=None, help="Profile the batch run")
+    parser.add_argument("--profile-output", default=None, help="Profile file (default: <output-dir>/profile.prof or profile.svg)")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or OPENAI_API_KEY)")
+    prompts = read_prompts(args.prompts) if args.prompts else sample_random_prompts(args.random)
+    results_path = args.results or os.path.join(args.output_dir, "results.jsonl")
+
+    generator = BatchGenerator(
+        args.api_key, args.output_dir, endpoint=args.endpoint, concurrency=args.concurrency,
+        temperature=args.temperature, max_retries=args.max_retries, requests_per_minute=args.requests_per_minute,
+        cache=None if args.no_cache else ResponseCache(deterministic_only=args.cache_deterministic_only),
+        retrieval_index=RetrievalIndex(args.retrieval_index) if args.retrieval_index else None, examples=args.examples,
+        candidates=args.candidates,
+    )
+    started = time.monotonic()
+    profile_path = args.profile_output or os.path.join(
+        args.output_dir, "profile.prof" if args.profile == "cprofile" else "profile.svg")
+    with generator.client, profiling(args.profile, profile_path):
+        results = asyncio.run(generator.run(prompts, results_path))
+    failed = sum(1 for result in results if "error" in result)
+    invalid = sum(1 for result in results if result.get("valid") is False)
+    print(f"Generated {len(results) - failed}/{len(results)} patches ({invalid} invalid) "
+          f"in {time.monotonic() - started:.1f}s; results in {results_path}")
+    print(f"Request latency: {json.dumps(generator.client.metrics.summary())}")
+    if args.metrics:
+        metrics.export(args.metrics)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
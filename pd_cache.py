@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "PureDataGPT", "responses.sqlite")
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 30 * 24 * 3600
+
+# Request fields that do not change what the model returns
+UNKEYED_FIELDS = ("stream",)
+
+# On-disk cache of validated patch bodies keyed on the full chat request: model,
+# messages and sampling parameters. Entries expire after ttl seconds, and the
+# least recently used ones are evicted once the cache holds more than
+# max_entries or max_bytes. With deterministic_only, only temperature-0
+# requests are cached, so sampled generations always go to the API
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl=DEFAULT_TTL, deterministic_only=False):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.deterministic_only = deterministic_only
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                choices TEXT,
+                size INTEGER,
+                created REAL,
+                accessed REAL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def key(data):
+        keyed = {field: value for field, value in data.items() if field not in UNKEYED_FIELDS}
+        return hashlib.sha256(json.dumps(keyed, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def cacheable(self, data):
+        return not self.deterministic_only or data.get("temperature", 1) == 0
+
+    # Returns the cached list of patch bodies (one per choice), or None on a miss
+    def get(self, data):
+        if not self.cacheable(data):
+            return None
+        key = self.key(data)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT choices, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.connection.commit()
+                return None
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, data, choices):
+        if not self.cacheable(data):
+            return
+        encoded = json.dumps(choices, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (self.key(data), encoded, len(encoded.encode("utf-8")), now, now),
+            )
+            self.evict(now)
+            self.connection.commit()
+
+    def evict(self, now):
+        self.connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        count, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        stale = []
+        for key, entry_size in rows:
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            stale.append((key,))
+            count -= 1
+            size -= entry_size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM responses")
+            self.connection.commit()
+
+response_cache = None
+
+def get_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache()
+    return response_cache
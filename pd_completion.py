@@ -0,0 +1,235 @@
+import time
+import json
+import threading
+
+from pd_metrics import increment, observe, percentile, timed
+
+OPENAI_CHAT_ENDPOINT = "https://api.openai.com/v1/chat/completions"
+MODEL_ENGINE = "gpt-3.5-turbo"
+MAX_TOKENS = 1024
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+
+def build_messages(prompt, examples=()):
+    messages = [
+        {"role": "system", "content": "You are a knowledgeable professor of audio technology that can generate complete PureData code."},
+    ]
+    # Few-shot examples retrieved from the training corpus, as prior request/answer turns
+    for title, patch in examples:
+        messages.append({"role": "user", "content": f"Represent the following as PureData code: {title}"})
+        messages.append({"role": "assistant", "content": patch})
+    messages += [
+        {"role": "user", "content": f"Represent the following as PureData code: {prompt}"},
+        {"role": "user", "content": f"Follow conventions outlined here:\n\nhttps://puredata.info/docs/manuals/pd/\nhttps://puredata.info/docs/ListOfPdExternals/"},
+        {"role": "user", "content": "Return only .pd code, no other text or information unrelated to the patch"},
+    ]
+    return messages
+
+def build_request_data(prompt, temperature, max_tokens=MAX_TOKENS, n=1, examples=()):
+    return {
+        "model": MODEL_ENGINE,
+        "messages": build_messages(prompt, examples),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "n": n,
+    }
+
+def build_headers(api_key):
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+
+class LatencyMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def record(self, status, first_byte, total, http_version):
+        with self.lock:
+            self.samples.append({"status": status, "first_byte": first_byte, "total": total, "http_version": http_version})
+        # Also feed the pipeline-wide metrics, so API latency shows up next to the other stages
+        increment("completion.requests")
+        if status != 200:
+            increment("completion.errors")
+        if first_byte is not None:
+            observe("completion.first_byte", first_byte)
+        observe("completion.total", total)
+
+    def summary(self):
+        with self.lock:
+            samples = list(self.samples)
+        first_byte = [sample["first_byte"] for sample in samples if sample["first_byte"] is not None]
+        total = [sample["total"] for sample in samples]
+        return {
+            "requests": len(samples),
+            "errors": sum(1 for sample in samples if sample["status"] != 200),
+            "first_byte_p50": percentile(first_byte, 0.5),
+            "first_byte_p95": percentile(first_byte, 0.95),
+            "total_p50": percentile(total, 0.5),
+            "total_p95": percentile(total, 0.95),
+            "http_versions": sorted({sample["http_version"] for sample in samples if sample["http_version"]}),
+        }
+
+# The HTTP stacks take tens of milliseconds to import, so they are loaded when
+# the first client is created rather than when this module is imported
+def import_httpx():
+    try:
+        import httpx
+        import h2  # noqa: F401 - httpx only negotiates HTTP/2 when h2 is installed
+    except ImportError:
+        return None
+    return httpx
+
+# Chat-completion client that keeps one pooled keep-alive session for its
+# lifetime, so repeated generations reuse the TCP/TLS connection instead of
+# paying a new DNS lookup and handshake each time. Uses httpx over HTTP/2 when
+# httpx and h2 are installed, otherwise a requests session
+class CompletionClient:
+    def __init__(self, api_key, endpoint=OPENAI_CHAT_ENDPOINT, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, pool_size=10, http2=True, verify=True):
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        self.metrics = LatencyMetrics()
+        headers = build_headers(api_key)
+        httpx = import_httpx() if http2 else None
+        self.uses_httpx = httpx is not None
+        if self.uses_httpx:
+            self.session = httpx.Client(
+                http2=True,
+                headers=headers,
+                verify=verify,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+            self.transport_errors = (httpx.HTTPError,)
+        else:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.session = requests.Session()
+            self.session.headers.update(headers)
+            self.session.verify = verify
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.transport_errors = (requests.RequestException,)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    # Send one request and read the whole body, recording time to first byte
+    # (response headers) and total time. Returns the response object
+    def post(self, data):
+        started = time.perf_counter()
+        status, first_byte, http_version = None, None, None
+        try:
+            if self.uses_httpx:
+                response = self.session.send(self.session.build_request("POST", self.endpoint, json=data), stream=True)
+                first_byte = time.perf_counter() - started
+                try:
+                    response.read()
+                finally:
+                    response.close()
+                http_version = response.http_version
+            else:
+                response = self.session.post(self.endpoint, json=data, timeout=self.timeout, stream=True)
+                first_byte = time.perf_counter() - started
+                response.content
+                http_version = "HTTP/1.1"
+            status = response.status_code
+            return response
+        finally:
+            self.metrics.record(status, first_byte, time.perf_counter() - started, http_version)
+
+    def complete(self, data):
+        try:
+            response = self.post(data)
+        except self.transport_errors as error:
+            return None, f"Error generating Pure Data code: {error}"
+        if response.status_code == 200:
+            return response.json(), None
+        return None, f"Error generating Pure Data code: {response.status_code} - {response.text}"
+
+    # Stream a completion over server-sent events, yielding (choice index, text)
+    # deltas as they arrive. Setting cancel_event closes the connection, which
+    # stops generation (and billing) for the rest of the completion
+    def stream(self, data, cancel_event=None):
+        data = dict(data, stream=True)
+        started = time.perf_counter()
+        status, first_byte, http_version = None, None, None
+        try:
+            if self.uses_httpx:
+                response = self.session.send(self.session.build_request("POST", self.endpoint, json=data), stream=True)
+                lines = response.iter_lines()
+                http_version = response.http_version
+            else:
+                response = self.session.post(self.endpoint, json=data, timeout=self.timeout, stream=True)
+                response.encoding = "utf-8"
+                lines = response.iter_lines(decode_unicode=True)
+                http_version = "HTTP/1.1"
+            status = response.status_code
+            try:
+                if status != 200:
+                    if self.uses_httpx:
+                        response.read()
+                    raise CompletionError(f"Error generating Pure Data code: {status} - {response.text}")
+                for line in lines:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    if not line or not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        return
+                    try:
+                        event = json.loads(payload)
+                    except ValueError as error:
+                        raise CompletionError(f"Error generating Pure Data code: malformed stream event: {error}") from error
+                    for choice in event.get("choices", []):
+                        delta = choice.get("delta", {}).get("content")
+                        if delta:
+                            if first_byte is None:
+                                first_byte = time.perf_counter() - started
+                            yield choice.get("index", 0), delta
+            finally:
+                response.close()
+        except self.transport_errors as error:
+            raise CompletionError(f"Error generating Pure Data code: {error}") from error
+        finally:
+            self.metrics.record(status, first_byte, time.perf_counter() - started, http_version)
+
+class CompletionError(Exception):
+    pass
+
+clients = {}
+clients_lock = threading.Lock()
+
+# One shared client per key and endpoint, so the GUI keeps its connection warm between clicks
+def get_client(api_key, endpoint=OPENAI_CHAT_ENDPOINT):
+    with clients_lock:
+        client = clients.get((api_key, endpoint))
+        if client is None:
+            client = clients[(api_key, endpoint)] = CompletionClient(api_key, endpoint)
+        return client
+
+# Request n candidate patches in a single call, returned in choice order
+@timed("generate_pd_candidates")
+def generate_pd_candidates(prompt, api_key, temperature, n=3, api_endpoint=OPENAI_CHAT_ENDPOINT):
+    data = build_request_data(prompt, temperature, n=n)
+    body, error = get_client(api_key, api_endpoint).complete(data)
+    if error:
+        return [], error
+    choices = sorted(body["choices"], key=lambda choice: choice.get("index", 0))
+    return [choice["message"]["content"] for choice in choices], None
+
+@timed("generate_pd_code")
+def generate_pd_code(prompt, api_key, temperature, api_endpoint=OPENAI_CHAT_ENDPOINT):
+    candidates, error = generate_pd_candidates(prompt, api_key, temperature, 1, api_endpoint)
+    return (candidates[0] if candidates else None), error
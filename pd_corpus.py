@@ -0,0 +1,316 @@
+import os
+import re
+import sys
+import json
+import shutil
+import sqlite3
+import hashlib
+import argparse
+from array import array
+from collections import Counter
+from urllib.parse import urlparse
+
+from pd_ingest import DEFAULT_CHUNK_SIZE, chunked, clean_content, load_sources, walk_corpus
+from pd_parser import parse
+from pd_retrieval import TITLE_PREFIX, estimate_tokens, iter_jsonl_documents, map_array
+
+DEFAULT_CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+FORMAT_VERSION = 1
+SHA256_BYTES = 32
+SHA256_NAME_RE = re.compile(r"^[0-9a-f]{64}$")
+# Variable-length string columns, each a UTF-8 blob plus an offsets array
+STRING_COLUMNS = ("title", "text", "source_url")
+COLUMNS = STRING_COLUMNS + ("sha256", "tokens", "objects", "classes")
+
+def training_prompt(title):
+    return f"{TITLE_PREFIX}{title}"
+
+# Object classes a patch instantiates, with how often, across all its subpatches
+def class_histogram(text):
+    return Counter(obj.name for obj in parse(text).iter_objects() if obj.record is not None and obj.name)
+
+# Where a crawled patch came from. PatchStore names files by their SHA-256, and
+# CrawlState maps that hash to the URL (and archive member) it was found at.
+# Returns the source URL and the patch's original name, or (None, None)
+class SourceLookup:
+    def __init__(self, state_path):
+        self.connection = sqlite3.connect(state_path) if state_path else None
+
+    def source(self, name):
+        stem = os.path.basename(name)[:-3]
+        if self.connection is None or not SHA256_NAME_RE.match(stem):
+            return None, None
+        row = self.connection.execute(
+            "SELECT url, member FROM patches WHERE sha256 = ? ORDER BY fetched LIMIT 1", (stem,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        url, member = row
+        original = os.path.basename(member or urlparse(url).path)
+        return (f"{url}#{member}" if member else url), (original[:-3] if original.endswith(".pd") else None)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+# Write a corpus as flat column files: every string column is one UTF-8 blob
+# addressed by an offsets array, hashes are fixed 32-byte rows, token and object
+# counts are plain arrays, and the class histograms are stored sparse (per-row
+# offsets into parallel class id and count arrays). The store is built in a
+# temporary directory and swapped in whole
+class CorpusWriter:
+    def __init__(self, corpus_dir, tokenizer=None):
+        self.corpus_dir = corpus_dir
+        self.build_dir = f"{corpus_dir}.tmp"
+        self.tokenizer = tokenizer
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+        os.makedirs(self.build_dir)
+        self.blobs = {name: open(self.column_path(name, "bin"), "wb") for name in STRING_COLUMNS}
+        self.offsets = {name: array("Q", [0]) for name in STRING_COLUMNS}
+        self.sha256 = open(self.column_path("sha256", "bin"), "wb")
+        self.tokens = array("I")
+        self.objects = array("I")
+        self.class_offsets = array("Q", [0])
+        self.class_ids = array("I")
+        self.class_counts = array("I")
+        self.classes = {}
+
+    def column_path(self, name, suffix):
+        return os.path.join(self.build_dir, f"{name}.{suffix}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    # Token counts are for the fine-tune record (prompt and completion), the
+    # text the max_tokens budget applies to
+    def count_tokens(self, titles, texts):
+        records = [f"{training_prompt(title)}\n\n {text}\n" for title, text in zip(titles, texts)]
+        if self.tokenizer is None:
+            return [estimate_tokens(record) for record in records]
+        return [len(encoding.ids) for encoding in self.tokenizer.encode_batch(records)]
+
+    # Append a batch of (title, text, source_url) rows
+    def add_batch(self, rows):
+        titles = [title for title, _, _ in rows]
+        texts = [text for _, text, _ in rows]
+        for (title, text, source_url), tokens in zip(rows, self.count_tokens(titles, texts)):
+            for name, value in (("title", title), ("text", text), ("source_url", source_url or "")):
+                encoded = value.encode("utf-8")
+                self.blobs[name].write(encoded)
+                self.offsets[name].append(self.offsets[name][-1] + len(encoded))
+            self.sha256.write(hashlib.sha256(text.encode("utf-8")).digest())
+            self.tokens.append(tokens)
+            histogram = class_histogram(text)
+            self.objects.append(sum(histogram.values()))
+            for name, count in sorted(histogram.items()):
+                self.class_ids.append(self.classes.setdefault(name, len(self.classes)))
+                self.class_counts.append(count)
+            self.class_offsets.append(len(self.class_ids))
+
+    def abort(self):
+        for file in (*self.blobs.values(), self.sha256):
+            file.close()
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+
+    def close(self):
+        for file in (*self.blobs.values(), self.sha256):
+            file.close()
+        arrays = [(f"{name}.offsets", offsets) for name, offsets in self.offsets.items()]
+        arrays += [("tokens", self.tokens), ("objects", self.objects), ("classes.offsets", self.class_offsets),
+                   ("classes.ids", self.class_ids), ("classes.counts", self.class_counts)]
+        for name, values in arrays:
+            with open(self.column_path(name, "bin"), "wb") as file:
+                values.tofile(file)
+        meta = {
+            "version": FORMAT_VERSION,
+            "rows": len(self.tokens),
+            "columns": list(COLUMNS),
+            "token_counts": "tokenizer" if self.tokenizer is not None else "estimate",
+            "classes": sorted(self.classes, key=self.classes.get),
+        }
+        with open(os.path.join(self.build_dir, "corpus.json"), "w", encoding="utf-8") as file:
+            json.dump(meta, file, ensure_ascii=False)
+        shutil.rmtree(self.corpus_dir, ignore_errors=True)
+        os.replace(self.build_dir, self.corpus_dir)
+        return meta["rows"]
+
+# Read-only view of a corpus built by CorpusWriter. Every column is memory-mapped,
+# so opening the store reads only corpus.json, a row costs one slice per column
+# asked for, and numeric columns are used in place without being copied
+class CorpusStore:
+    def __init__(self, corpus_dir=DEFAULT_CORPUS_DIR):
+        with open(os.path.join(corpus_dir, "corpus.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported corpus format version {meta['version']} in {corpus_dir}")
+        self.rows = meta["rows"]
+        self.token_counts = meta["token_counts"]
+        self.class_names = meta["classes"]
+        self.blobs = {name: map_array(os.path.join(corpus_dir, f"{name}.bin"), "B") for name in STRING_COLUMNS}
+        self.offsets = {name: map_array(os.path.join(corpus_dir, f"{name}.offsets.bin"), "Q") for name in STRING_COLUMNS}
+        self.sha256_blob = map_array(os.path.join(corpus_dir, "sha256.bin"), "B")
+        self.tokens = map_array(os.path.join(corpus_dir, "tokens.bin"), "I")
+        self.objects = map_array(os.path.join(corpus_dir, "objects.bin"), "I")
+        self.class_offsets = map_array(os.path.join(corpus_dir, "classes.offsets.bin"), "Q")
+        self.class_ids = map_array(os.path.join(corpus_dir, "classes.ids.bin"), "I")
+        self.class_counts = map_array(os.path.join(corpus_dir, "classes.counts.bin"), "I")
+
+    def __len__(self):
+        return self.rows
+
+    # The raw UTF-8 bytes of a string column, as a view into the mapped file
+    def raw(self, name, row):
+        offsets = self.offsets[name]
+        return self.blobs[name][offsets[row]:offsets[row + 1]]
+
+    def string(self, name, row):
+        return str(self.raw(name, row), "utf-8")
+
+    def title(self, row):
+        return self.string("title", row)
+
+    def text(self, row):
+        return self.string("text", row)
+
+    def source_url(self, row):
+        return self.string("source_url", row) or None
+
+    def sha256(self, row):
+        return self.sha256_blob[row * SHA256_BYTES:(row + 1) * SHA256_BYTES].hex()
+
+    def classes(self, row):
+        start, end = self.class_offsets[row], self.class_offsets[row + 1]
+        return {self.class_names[class_id]: count
+                for class_id, count in zip(self.class_ids[start:end], self.class_counts[start:end])}
+
+    def value(self, name, row):
+        if name in STRING_COLUMNS:
+            return self.string(name, row) if name != "source_url" else self.source_url(row)
+        if name == "sha256":
+            return self.sha256(row)
+        if name in ("tokens", "objects"):
+            return getattr(self, name)[row]
+        if name == "classes":
+            return self.classes(row)
+        raise KeyError(f"Unknown column: {name}")
+
+    # Yield the given columns of the given rows (all rows by default) as dicts;
+    # columns that are not asked for are never touched
+    def select(self, columns=COLUMNS, rows=None):
+        for row in range(self.rows) if rows is None else rows:
+            yield {name: self.value(name, row) for name in columns}
+
+    # Rows in the {"prompt": ..., "completion": ...} fine-tune format, dropping
+    # those at or over max_tokens the way the dataset build does
+    def iter_records(self, max_tokens=None):
+        for row in range(self.rows):
+            if max_tokens is None or self.tokens[row] < max_tokens:
+                yield {"prompt": training_prompt(self.title(row)), "completion": f" {self.text(row)}\n"}
+
+    # Corpus-wide totals, read from the numeric columns alone
+    def stats(self, top=20):
+        class_totals = Counter()
+        for class_id, count in zip(self.class_ids, self.class_counts):
+            class_totals[class_id] += count
+        tokens = sorted(self.tokens)
+        unique = len({bytes(self.sha256_blob[row * SHA256_BYTES:(row + 1) * SHA256_BYTES]) for row in range(self.rows)})
+        return {
+            "rows": self.rows,
+            "unique_texts": unique,
+            "bytes": self.offsets["text"][self.rows] if self.rows else 0,
+            "tokens": sum(tokens),
+            "token_counts": self.token_counts,
+            "tokens_p50": tokens[len(tokens) // 2] if tokens else None,
+            "tokens_max": tokens[-1] if tokens else None,
+            "objects": sum(self.objects),
+            "classes": len(self.class_names),
+            "top_classes": [(self.class_names[class_id], count) for class_id, count in class_totals.most_common(top)],
+        }
+
+# (title, text, source_url) rows for every patch under folder_path, decoded
+# and cleaned like the dataset build. Crawled patches are titled by the name
+# they were published under rather than their hash
+def iter_folder_rows(folder_path, state_path=None, errors=None):
+    lookup = SourceLookup(state_path)
+    try:
+        for source, content, _, error in load_sources(walk_corpus(folder_path, errors)):
+            if error is not None:
+                if errors is not None:
+                    errors.append({"path": source.key, "error": error})
+                continue
+            source_url, title = lookup.source(source.name)
+            yield title or os.path.basename(source.name)[:-3], clean_content(content), source_url
+    finally:
+        lookup.close()
+
+def iter_jsonl_rows(path):
+    for title, text in iter_jsonl_documents(path):
+        yield title, text, None
+
+def build_corpus(rows, corpus_dir=DEFAULT_CORPUS_DIR, tokenizer=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    with CorpusWriter(corpus_dir, tokenizer) as writer:
+        for batch in chunked(rows, chunk_size):
+            writer.add_batch(batch)
+    return len(writer.tokens)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, inspect and export the columnar corpus store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build")
+    build.add_argument("source", help="Folder of .pd files (and .zip archives), or a prompt/completion JSONL dataset")
+    build.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    build.add_argument("--state", default=None, help="Crawl state database, to record each patch's source URL")
+    build.add_argument("--tokenizer", default=None, help="Tokenizer JSON for exact token counts (default: estimate)")
+    stats = commands.add_parser("stats")
+    stats.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    stats.add_argument("--top", type=int, default=20, help="Most common object classes to list")
+    show = commands.add_parser("show")
+    show.add_argument("rows", type=int, nargs="+")
+    show.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    show.add_argument("--columns", default="title,source_url,sha256,tokens,objects",
+                      help=f"Comma-separated columns out of {','.join(COLUMNS)}")
+    export = commands.add_parser("export")
+    export.add_argument("output", help="Fine-tune JSONL to write")
+    export.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    export.add_argument("--max-tokens", type=int, default=None)
+    export.add_argument("--max-shard-bytes", type=int, default=None)
+    export.add_argument("--compression", choices=["gzip", "zstd"], default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        tokenizer = None
+        if args.tokenizer:
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_file(args.tokenizer)
+        errors = []
+        rows = (iter_folder_rows(args.source, args.state, errors) if os.path.isdir(args.source)
+                else iter_jsonl_rows(args.source))
+        count = build_corpus(rows, args.corpus_dir, tokenizer)
+        print(f"Stored {count} patches in {args.corpus_dir}")
+        for error in errors:
+            print(f"Skipped {error['path']}: {error['error']}")
+        return 0
+
+    store = CorpusStore(args.corpus_dir)
+    if args.command == "stats":
+        print(json.dumps(store.stats(args.top), indent=2, ensure_ascii=False))
+    elif args.command == "show":
+        columns = args.columns.split(",")
+        for row in store.select(columns, args.rows):
+            print(json.dumps(row, ensure_ascii=False))
+    else:
+        from processTrainingData import save_to_jsonl
+
+        manifest = save_to_jsonl(store.iter_records(args.max_tokens), args.output, args.max_shard_bytes, args.compression)
+        print(f"Wrote {manifest['records']} records to {len(manifest['shards'])} shard(s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
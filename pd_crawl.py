@@ -0,0 +1,287 @@
+import io
+import os
+import re
+import time
+import zlib
+import sqlite3
+import hashlib
+import zipfile
+from collections import Counter
+from urllib.parse import urlparse
+
+from pd_ingest import is_pd_name
+
+DEFAULT_STATE_PATH = os.path.join("crawls", "pd_downloads.sqlite")
+# Limits on what one archive may expand to, so a zip bomb costs nothing but a skipped download
+MAX_MEMBER_BYTES = 4 * 1024 * 1024
+MAX_ARCHIVE_BYTES = 64 * 1024 * 1024
+MAX_ARCHIVE_MEMBERS = 5000
+
+# What the scraper knows about every file it has downloaded: the validators
+# the server sent (ETag, Last-Modified) and a hash of the body, so a re-crawl
+# can ask only for files that changed and skip bodies it already stored
+class CrawlState:
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                sha256 TEXT,
+                size INTEGER,
+                path TEXT,
+                fetched REAL,
+                checked REAL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS patches (
+                sha256 TEXT,
+                url TEXT,
+                member TEXT,
+                path TEXT,
+                size INTEGER,
+                fetched REAL,
+                PRIMARY KEY (sha256, url, member)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS sections (
+                section TEXT PRIMARY KEY,
+                pages INTEGER,
+                patches INTEGER
+            )
+        """)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, url):
+        row = self.connection.execute(
+            "SELECT etag, last_modified, sha256, size, path FROM downloads WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("etag", "last_modified", "sha256", "size", "path"), row))
+
+    # Headers that turn a re-fetch into a conditional request
+    def conditional_headers(self, url):
+        previous = self.get(url)
+        headers = {}
+        if previous is not None:
+            if previous["etag"]:
+                headers["If-None-Match"] = previous["etag"]
+            if previous["last_modified"]:
+                headers["If-Modified-Since"] = previous["last_modified"]
+        return headers
+
+    def record(self, url, etag, last_modified, sha256, size, path):
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, etag, last_modified, sha256, size, path, now, now),
+        )
+        self.connection.commit()
+
+    # The server confirmed (or the hash showed) that the stored copy is current
+    def mark_unchanged(self, url, etag=None, last_modified=None):
+        self.connection.execute(
+            "UPDATE downloads SET checked = ?, etag = COALESCE(?, etag), "
+            "last_modified = COALESCE(?, last_modified) WHERE url = ?",
+            (time.time(), etag, last_modified, url),
+        )
+        self.connection.commit()
+
+    # Where a stored patch came from: the URL, and the member name inside an archive
+    def record_patch(self, sha256, url, member, path, size):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO patches VALUES (?, ?, ?, ?, ?, ?)",
+            (sha256, url, member or "", path, size, time.time()),
+        )
+        self.connection.commit()
+
+    # How many pages of each site section were parsed and how many patch links they held
+    def section_yields(self):
+        return {row[0]: row[1:] for row in self.connection.execute("SELECT section, pages, patches FROM sections")}
+
+    def record_section(self, section, patch_links):
+        self.connection.execute(
+            "INSERT INTO sections VALUES (?, 1, ?) "
+            "ON CONFLICT(section) DO UPDATE SET pages = pages + 1, patches = patches + excluded.patches",
+            (section, patch_links),
+        )
+        self.connection.commit()
+
+# Per-domain crawl rules: URL patterns that lead towards patches (follow) or
+# away from them (avoid), and how deep and how many pages each site may take
+DOMAIN_RULES = {
+    "aspress.co.uk": {"follow": [r"/sd/"], "avoid": [], "max_depth": 3},
+    "puredata.info": {
+        "follow": [r"/downloads", r"/patches", r"/member-downloads"],
+        "avoid": [r"login_form", r"mail_password", r"sendto_form", r"/author/", r"/search", r"/news/", r"/docs/manuals"],
+        "max_depth": 4,
+    },
+    "patchstorage.com": {
+        "follow": [r"/platform/pd-vanilla", r"/page/\d+"],
+        "avoid": [r"/author/", r"/tag/", r"/login", r"/register", r"/wp-", r"/platform/(?!pd-vanilla)"],
+        "max_depth": 4,
+    },
+    "martin-brinkmann.de": {"follow": [r"pd"], "avoid": [], "max_depth": 2},
+    "oscilloscopemusic.com": {"follow": [r"/software/"], "avoid": [r"/shop", r"/cart", r"/account"], "max_depth": 2},
+    "pdpatchrepo.info": {
+        "follow": [r"/topic/", r"/category/2/"],
+        "avoid": [r"/user/", r"/users", r"/login", r"/register", r"/tags", r"/groups", r"/search", r"/recent",
+                  r"/popular", r"/compose"],
+        "max_depth": 5,
+    },
+}
+DEFAULT_RULES = {"follow": [], "avoid": [], "max_depth": 3}
+# Links no site needs followed
+AVOID_PATTERNS = [
+    r"login", r"logout", r"signin", r"signup", r"register", r"/tags?/", r"/feed/?$", r"\?replytocom=", r"/print/",
+    r"\.(?:jpe?g|png|gif|svg|css|js|pdf|mp3|wav|ogg|mp4|mov)(?:\?|$)",
+]
+ANCHOR_KEYWORDS = {
+    r"\bpatch(?:es)?\b": 15, r"\bdownloads?\b": 15, r"\bexamples?\b": 10, r"\babstractions?\b": 10, r"\bpd\b": 5,
+    r"\bnext\b|\bolder\b|\u00bb": 5,
+}
+MAX_PAGES_PER_DOMAIN = 2000
+# Stop following navigation on a domain after this many pages in a row without a patch link
+STALL_PAGES = 300
+DOWNLOAD_PRIORITY = 100
+
+def domain_key(url):
+    host = (urlparse(url).hostname or "").lower()
+    for domain in DOMAIN_RULES:
+        if host == domain or host.endswith("." + domain):
+            return domain
+    return host
+
+# Pages are grouped into sections by their first path segment for the yield history
+def section_key(url):
+    path = urlparse(url).path.strip("/")
+    return f"{domain_key(url)}/{path.split('/')[0] if path else ''}"
+
+def is_patch_url(url):
+    return urlparse(url).path.lower().endswith((".pd", ".zip"))
+
+# Ranks candidate links for the crawl frontier from the URL, the anchor text,
+# the depth and how many patch links earlier pages in the same section
+# yielded, and enforces the per-domain depth, page and stall budgets
+class LinkFrontier:
+    def __init__(self, state=None, max_pages=MAX_PAGES_PER_DOMAIN, stall_pages=STALL_PAGES):
+        self.state = state
+        self.max_pages = max_pages
+        self.stall_pages = stall_pages
+        self.section_yields = state.section_yields() if state is not None else {}
+        self.pages = Counter()
+        self.pages_since_yield = Counter()
+        self.rules = {
+            domain: {key: [re.compile(pattern) for pattern in rules[key]] for key in ("follow", "avoid")}
+            for domain, rules in DOMAIN_RULES.items()
+        }
+        self.avoid = [re.compile(pattern, re.I) for pattern in AVOID_PATTERNS]
+        self.anchor_keywords = [(re.compile(pattern, re.I), weight) for pattern, weight in ANCHOR_KEYWORDS.items()]
+
+    def exhausted(self, domain):
+        return self.pages[domain] >= self.max_pages or self.pages_since_yield[domain] >= self.stall_pages
+
+    # Higher is fetched sooner; None means the link is not worth following
+    def score(self, url, anchor_text, depth):
+        domain = domain_key(url)
+        if self.exhausted(domain) or depth > DOMAIN_RULES.get(domain, DEFAULT_RULES)["max_depth"]:
+            return None
+        rules = self.rules.get(domain, {"follow": [], "avoid": []})
+        if any(pattern.search(url) for pattern in self.avoid + rules["avoid"]):
+            return None
+
+        score = -10 * depth
+        if any(pattern.search(url) for pattern in rules["follow"]):
+            score += 30
+        score += sum(weight for pattern, weight in self.anchor_keywords if pattern.search(anchor_text))
+        pages, patches = self.section_yields.get(section_key(url), (0, 0))
+        if pages >= 3:
+            score += min(40, int(20 * patches / pages)) if patches else -20
+        return score
+
+    def page_done(self, url, patch_links):
+        domain = domain_key(url)
+        self.pages[domain] += 1
+        self.pages_since_yield[domain] = 0 if patch_links else self.pages_since_yield[domain] + 1
+        section = section_key(url)
+        pages, patches = self.section_yields.get(section, (0, 0))
+        self.section_yields[section] = (pages + 1, patches + patch_links)
+        if self.state is not None:
+            self.state.record_section(section, patch_links)
+
+def is_archive_url(url):
+    return urlparse(url).path.lower().endswith(".zip")
+
+def looks_like_patch(data):
+    return data.lstrip(b"\xef\xbb\xbf \t\r\n")[:2] == b"#N"
+
+# Yield (member name, bytes) for the .pd members of an in-memory archive,
+# decompressing each one only up to max_member_bytes and stopping once the
+# archive has expanded to max_total_bytes. Problems are appended to skipped
+def iter_archive_patches(body, skipped, max_member_bytes=MAX_MEMBER_BYTES, max_total_bytes=MAX_ARCHIVE_BYTES,
+                         max_members=MAX_ARCHIVE_MEMBERS):
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        total = 0
+        for index, info in enumerate(archive.infolist()):
+            if index == max_members:
+                skipped.append(f"more than {max_members} entries")
+                return
+            if info.is_dir() or not is_pd_name(info.filename):
+                continue
+            if info.file_size > max_member_bytes:
+                skipped.append(f"{info.filename}: {info.file_size} bytes")
+                continue
+            try:
+                with archive.open(info) as member:
+                    # The declared size can lie, so never decompress past the limit
+                    data = member.read(max_member_bytes + 1)
+            except (zipfile.BadZipFile, RuntimeError, NotImplementedError, zlib.error, EOFError) as error:
+                skipped.append(f"{info.filename}: {error}")
+                continue
+            if len(data) > max_member_bytes:
+                skipped.append(f"{info.filename}: over {max_member_bytes} bytes")
+                continue
+            total += len(data)
+            if total > max_total_bytes:
+                skipped.append(f"archive expands past {max_total_bytes} bytes")
+                return
+            yield info.filename, data
+
+# Patches stored under the SHA-256 of their own content, so the same patch
+# found in several archives or pages is written once, and names inside
+# different archives cannot collide. Provenance goes to CrawlState
+class PatchStore:
+    def __init__(self, directory, state):
+        self.directory = directory
+        self.state = state
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, sha256):
+        return os.path.join(self.directory, f"{sha256}.pd")
+
+    # Returns the stored path, or None when the content is not a patch
+    def store(self, data, url, member=None):
+        if not looks_like_patch(data):
+            return None
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path(sha256)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        self.state.record_patch(sha256, url, member, path, len(data))
+        return path
+
+    def store_archive(self, body, url, skipped):
+        return [path for path in (self.store(data, url, member) for member, data in iter_archive_patches(body, skipped))
+                if path is not None]
@@ -0,0 +1,110 @@
+import re
+import random
+import hashlib
+from collections import defaultdict
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# Records whose first two atoms are followed by canvas coordinates. The
+# coordinates are dropped from shingles so a copy that was only rearranged on
+# screen still counts as the same patch
+POSITIONED_RECORDS = ("#X obj", "#X msg", "#X floatatom", "#X symbolatom", "#X listbox", "#X text")
+
+def split_records(content):
+    for record in re.split(r"(?<!\\);", content):
+        atoms = record.split()
+        if atoms:
+            yield atoms
+
+# Shingle a patch into the set of its #X records, with whitespace (including the
+# wrapped continuation lines Pd writes) collapsed and coordinates removed
+def patch_shingles(content):
+    shingles = set()
+    for atoms in split_records(content):
+        if atoms[0] != "#X":
+            continue
+        if " ".join(atoms[:2]) in POSITIONED_RECORDS:
+            atoms = atoms[:2] + atoms[4:]
+        shingles.add(" ".join(atoms))
+    return shingles
+
+def content_digest(content):
+    return hashlib.sha256(content.strip().encode("utf-8")).hexdigest()
+
+class PatchDeduplicator:
+    def __init__(self, threshold=0.85, num_perm=128, bands=16, min_shingles=5, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.min_shingles = min_shingles
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME)) for _ in range(num_perm)]
+        self.exact = {}
+        self.signatures = {}
+        self.buckets = defaultdict(list)
+        self.clusters = defaultdict(list)
+        self.kept = 0
+
+    def minhash(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+                  for shingle in shingles]
+        return tuple(min(((a * value + b) % MERSENNE_PRIME) & MAX_HASH for value in hashes)
+                     for a, b in self.permutations)
+
+    def band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, hash(signature[band * self.rows:(band + 1) * self.rows])
+
+    # Returns the key of the patch this one duplicates, or None if it should be
+    # kept. Kept patches are indexed so later copies collapse onto them; only
+    # LSH bucket collisions are compared, never every pair
+    def check(self, key, content):
+        digest = content_digest(content)
+        if digest in self.exact:
+            original = self.exact[digest]
+            self.clusters[original].append({"key": key, "match": "exact", "similarity": 1.0})
+            return original
+
+        shingles = patch_shingles(content)
+        signature = None
+        if len(shingles) >= self.min_shingles:
+            signature = self.minhash(shingles)
+            best_key, best_similarity = None, 0.0
+            candidates = {candidate for band_key in self.band_keys(signature) for candidate in self.buckets[band_key]}
+            for candidate in candidates:
+                other = self.signatures[candidate]
+                similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+                if similarity > best_similarity:
+                    best_key, best_similarity = candidate, similarity
+            if best_key is not None and best_similarity >= self.threshold:
+                self.clusters[best_key].append({"key": key, "match": "near", "similarity": round(best_similarity, 3)})
+                return best_key
+
+        self.exact[digest] = key
+        self.kept += 1
+        if signature is not None:
+            self.signatures[key] = signature
+            for band_key in self.band_keys(signature):
+                self.buckets[band_key].append(key)
+        return None
+
+    def report(self):
+        clusters = [{"kept": key, "duplicates": duplicates} for key, duplicates in self.clusters.items()]
+        clusters.sort(key=lambda cluster: len(cluster["duplicates"]), reverse=True)
+        return {
+            "threshold": self.threshold,
+            "kept": self.kept,
+            "dropped": sum(len(cluster["duplicates"]) for cluster in clusters),
+            "clusters": clusters,
+        }
+
+# Deduplicate (source, record) pairs, yielding the records that are kept. Patches
+# are keyed by their source path: the prompt only holds the file name, which
+# patches from different folders and archives share
+def iter_deduplicated(sourced_records, deduplicator):
+    for source, record in sourced_records:
+        if deduplicator.check(source, record["completion"]) is None:
+            yield record
@@ -0,0 +1,154 @@
+import os
+import zlib
+import codecs
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from charset_normalizer import from_bytes as detect_charset
+except ImportError:
+    detect_charset = None
+
+DEFAULT_CHUNK_SIZE = 64
+
+# One patch in the corpus: a loose .pd file, or a .pd member of a .zip archive
+# (read in place, never extracted). Archive members share the archive's mtime
+class SourceRef(namedtuple("SourceRef", "path member size mtime_ns")):
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return f"{self.path}!{self.member}" if self.member else self.path
+
+    @property
+    def name(self):
+        return self.member or self.path
+
+def is_pd_name(name):
+    return name.endswith(".pd") and not os.path.basename(name).startswith("._")
+
+# Walk the tree with os.scandir in sorted order (each directory's files before
+# its subdirectories) and list .pd members of archives without extracting them.
+# Unreadable directories and archives are appended to errors
+def walk_corpus(folder_path, errors=None):
+    pending = [folder_path]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as scan:
+                entries = sorted(scan, key=lambda entry: entry.name)
+        except OSError as error:
+            if errors is not None:
+                errors.append({"path": directory, "error": f"{type(error).__name__}: {error}"})
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif is_pd_name(entry.name):
+                stat = entry.stat()
+                yield SourceRef(entry.path, None, stat.st_size, stat.st_mtime_ns)
+            elif entry.name.endswith(".zip"):
+                yield from walk_archive(entry, errors)
+        pending.extend(reversed(subdirectories))
+
+def walk_archive(entry, errors=None):
+    stat = entry.stat()
+    try:
+        with zipfile.ZipFile(entry.path) as archive:
+            members = sorted(info.filename for info in archive.infolist() if not info.is_dir() and is_pd_name(info.filename))
+            sizes = {info.filename: info.file_size for info in archive.infolist()}
+    except (OSError, zipfile.BadZipFile) as error:
+        if errors is not None:
+            errors.append({"path": entry.path, "error": f"{type(error).__name__}: {error}"})
+        return
+    for member in members:
+        yield SourceRef(entry.path, member, sizes[member], stat.st_mtime_ns)
+
+# Decode patch bytes, trying UTF-8 first, then a detected charset when
+# charset_normalizer is installed, then cp1252 and finally Latin-1, which never
+# fails. Newlines are normalized the way text-mode reads normalize them
+def decode_patch(raw):
+    if raw.startswith(codecs.BOM_UTF8):
+        text, encoding = raw[len(codecs.BOM_UTF8):].decode("utf-8", "replace"), "utf-8-sig"
+    else:
+        try:
+            text, encoding = raw.decode("utf-8"), "utf-8"
+        except UnicodeDecodeError:
+            text = encoding = None
+            if detect_charset is not None:
+                match = detect_charset(raw).best()
+                if match is not None:
+                    text, encoding = str(match), match.encoding
+            if text is None:
+                try:
+                    text, encoding = raw.decode("cp1252"), "cp1252"
+                except UnicodeDecodeError:
+                    text, encoding = raw.decode("latin-1"), "latin-1"
+    return text.replace("\r\n", "\n").replace("\r", "\n"), encoding
+
+# Collapse tabs, drop carriage returns and strip every line: the text the
+# dataset and its token budget are computed from
+def clean_content(content):
+    content = content.replace("\t", " ").replace("\r", "").strip()
+    return "\n".join(line.strip() for line in content.split("\n"))
+
+def read_source(ref, archives):
+    if ref.member is None:
+        with open(ref.path, "rb") as file:
+            return file.read()
+    archive = archives.get(ref.path)
+    if archive is None:
+        archive = archives[ref.path] = zipfile.ZipFile(ref.path)
+    return archive.read(ref.member)
+
+# Read and decode a chunk of sources, yielding (ref, text, encoding, error) so
+# that one unreadable file is reported instead of aborting the whole build
+def load_sources(refs):
+    archives = {}
+    try:
+        for ref in refs:
+            try:
+                text, encoding = decode_patch(read_source(ref, archives))
+            except (OSError, zipfile.BadZipFile, zlib.error, EOFError, KeyError, RuntimeError) as error:
+                yield ref, None, None, f"{type(error).__name__}: {error}"
+            else:
+                yield ref, text, encoding, None
+    finally:
+        for archive in archives.values():
+            archive.close()
+
+def chunked(refs, chunk_size):
+    chunk = []
+    for ref in refs:
+        chunk.append(ref)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Run process_chunk over chunks of refs and yield its per-source results in
+# corpus order. With more than one worker the chunks fan out over a process
+# pool, keeping only a couple of chunks per worker in flight so memory stays
+# flat however large the corpus is. process_chunk and initializer must be
+# importable top-level functions
+def ingest(refs, process_chunk, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, initializer=None, initargs=(),
+           mp_context=None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for chunk in chunked(refs, chunk_size):
+            yield from process_chunk(chunk)
+        return
+
+    with ProcessPoolExecutor(workers, mp_context, initializer, initargs) as executor:
+        in_flight = deque()
+        for chunk in chunked(refs, chunk_size):
+            in_flight.append(executor.submit(process_chunk, chunk))
+            if len(in_flight) >= workers * 2:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import time
+import signal
+import inspect
+import shutil
+import threading
+import functools
+import contextlib
+import subprocess
+
+# Samples kept per span for the percentiles; counts and sums cover every call
+MAX_SAMPLES = 2048
+PROMETHEUS_PREFIX = "pdgpt"
+PROMETHEUS_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# Timings and counters shared by the dataset build, the crawler and the
+# generation path. A span is a named duration (seconds); a counter is a running
+# total. Both are cheap enough to leave on, and are exported as JSON or as
+# Prometheus text when a run ends
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = {"count": 0, "total": 0.0, "min": seconds, "max": seconds, "samples": []}
+            span["count"] += 1
+            span["total"] += seconds
+            span["min"] = min(span["min"], seconds)
+            span["max"] = max(span["max"], seconds)
+            samples = span["samples"]
+            if len(samples) == MAX_SAMPLES:
+                # Keep a rolling window so long runs stay bounded in memory
+                del samples[:MAX_SAMPLES // 2]
+            samples.append(seconds)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    # Decorator form of span; generators are timed until they are exhausted or closed
+    def timed(self, name):
+        def decorate(function):
+            if inspect.isgeneratorfunction(function):
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    with self.span(name):
+                        yield from function(*args, **kwargs)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def snapshot(self):
+        with self.lock:
+            spans = {name: dict(span, samples=list(span["samples"])) for name, span in self.spans.items()}
+            counters = dict(self.counters)
+        return {
+            "spans": {
+                name: {
+                    "count": span["count"],
+                    "total": span["total"],
+                    "mean": span["total"] / span["count"],
+                    "min": span["min"],
+                    "max": span["max"],
+                    "p50": percentile(span["samples"], 0.5),
+                    "p95": percentile(span["samples"], 0.95),
+                }
+                for name, span in sorted(spans.items())
+            },
+            "counters": dict(sorted(counters.items())),
+        }
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = [
+            f"# HELP {PROMETHEUS_PREFIX}_span_seconds Time spent in instrumented pipeline stages",
+            f"# TYPE {PROMETHEUS_PREFIX}_span_seconds summary",
+        ]
+        for name, span in snapshot["spans"].items():
+            label = f'span="{name}"'
+            for quantile in ("0.5", "0.95"):
+                value = span["p50" if quantile == "0.5" else "p95"]
+                lines.append(f'{PROMETHEUS_PREFIX}_span_seconds{{{label},quantile="{quantile}"}} {value!r}')
+            lines.append(f"{PROMETHEUS_PREFIX}_span_seconds_sum{{{label}}} {span['total']!r}")
+            lines.append(f"{PROMETHEUS_PREFIX}_span_seconds_count{{{label}}} {span['count']}")
+        for name, value in snapshot["counters"].items():
+            metric = f"{PROMETHEUS_PREFIX}_{PROMETHEUS_NAME_RE.sub('_', name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics to path: Prometheus text for .prom files, JSON otherwise
+    def export(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            if path.endswith(".prom"):
+                file.write(self.prometheus_text())
+            else:
+                json.dump(self.snapshot(), file, indent=2)
+
+    def summary_lines(self):
+        return [
+            f"{name}: {span['count']} x {span['mean'] * 1000:.1f} ms (total {span['total']:.2f} s)"
+            for name, span in self.snapshot()["spans"].items()
+        ]
+
+# The process-wide registry every module records into
+metrics = Metrics()
+span = metrics.span
+timed = metrics.timed
+observe = metrics.observe
+increment = metrics.increment
+
+# Profile the enclosed block. "cprofile" writes a .prof file for pstats or
+# snakeviz; "py-spy" samples this process from outside into a flame graph SVG,
+# which also covers time spent in native code such as the tokenizer. With
+# profiler=None the block runs as is
+@contextlib.contextmanager
+def profiling(profiler, output_path):
+    if profiler is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    if profiler == "cprofile":
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output_path)
+            print(f"cProfile stats written to {output_path}")
+    elif profiler == "py-spy":
+        py_spy = shutil.which("py-spy")
+        if py_spy is None:
+            print("py-spy not found; running without a profiler")
+            yield
+            return
+        recorder = subprocess.Popen([py_spy, "record", "--pid", str(os.getpid()), "--output", output_path, "--native"])
+        try:
+            yield
+        finally:
+            # py-spy writes its output when interrupted
+            recorder.send_signal(signal.SIGINT)
+            recorder.wait()
+            print(f"py-spy flame graph written to {output_path}")
+    else:
+        raise ValueError(f"Unknown profiler: {profiler}")
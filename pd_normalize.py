@@ -0,0 +1,383 @@
+import os
+import sys
+import json
+import heapq
+import argparse
+from array import array
+
+from pd_ingest import clean_content, load_sources, walk_corpus
+from pd_parser import PdObject, PdRecord, parse, serialize
+from pd_retrieval import estimate_tokens
+from pd_validator import validate_patch
+
+# Box positions are snapped to this grid, with the top-left object moved to 0 0
+GRID = 10
+# Window geometry every canvas header is reset to (x, y, width, height)
+DEFAULT_WINDOW = ("0", "50", "450", "300")
+PORT_CLASSES = {"inlet": "inlets", "inlet~": "inlets", "outlet": "outlets", "outlet~": "outlets"}
+
+# IEM GUI objects are created with their defaults when given no arguments, but
+# Pd only reads their arguments when all of them are there. So the arguments
+# are dropped only when everything that affects behaviour has its default
+# value: (numeric defaults by argument index, indices of send/receive/label
+# names that must be empty). Sizes, colours and label placement are cosmetic
+IEM_DEFAULTS = {
+    "bng": ({3: 0}, (4, 5, 6)),
+    "tgl": ({1: 0, 13: 1}, (2, 3, 4)),
+    "hsl": ({2: 0, 3: 127, 4: 0, 5: 0, 17: 1}, (6, 7, 8)),
+    "vsl": ({2: 0, 3: 127, 4: 0, 5: 0, 17: 1}, (6, 7, 8)),
+    "nbx": ({2: -1e37, 3: 1e37, 4: 0, 5: 0}, (6, 7, 8)),
+    "hradio": ({2: 0, 3: 8}, (4, 5, 6)),
+    "vradio": ({2: 0, 3: 8}, (4, 5, 6)),
+    "vu": ({}, (2, 3)),
+}
+IEM_ALIASES = {"hslider": "hsl", "vslider": "vsl", "hdl": "hradio", "vdl": "vradio"}
+EMPTY_NAMES = ("empty", "-")
+# floatatom/symbolatom/listbox arguments after the width; Pd reads missing
+# trailing arguments as 0 or an empty name, so those may be left off
+ATOM_TRAILING_DEFAULTS = ("0", "0", "0", "-", "-", "-", "0")
+# Pd creates arrays zeroed and #A records only set the values they list, so
+# zeros need not be saved. A run of at least this many zeros inside the data is
+# cheaper as a new #A record starting after it than written out
+ZERO_RUN = 5
+
+def same_number(atom, value):
+    try:
+        return float(atom) == value
+    except ValueError:
+        return False
+
+def default_iem_args(name, args):
+    name = IEM_ALIASES.get(name, name)
+    if name not in IEM_DEFAULTS or not args:
+        return False
+    numbers, names = IEM_DEFAULTS[name]
+    if any(index >= len(args) for index in (*numbers, *names)):
+        return False
+    return (all(same_number(args[index], value) for index, value in numbers.items())
+            and all(args[index] in EMPTY_NAMES for index in names))
+
+# The object's creation atoms with default GUI parameters removed
+def reset_gui_args(obj, atoms):
+    if obj.kind == "obj" and len(atoms) > 4 and default_iem_args(atoms[4], atoms[5:]):
+        return atoms[:5]
+    if obj.kind in ("floatatom", "symbolatom", "listbox") and len(atoms) > 5:
+        head, trailing = atoms[:5], list(atoms[5:])
+        while trailing and len(trailing) <= len(ATOM_TRAILING_DEFAULTS) \
+                and trailing[-1] == ATOM_TRAILING_DEFAULTS[len(trailing) - 1]:
+            trailing.pop()
+        return head + tuple(trailing)
+    return atoms
+
+def grid_value(value, origin, grid):
+    return int(round((value - origin) / grid))
+
+# New (x, y) for every positioned object of a canvas, snapped to the grid, or
+# with scale written in grid units (multiply by the grid to get the layout
+# back). Pd orders a subpatch's inlets and outlets by x, with ties going to the
+# object created first, so ports that the grid or the new object order would
+# tie are nudged apart to keep every port where it was
+def canvas_positions(canvas, grid, scale=False):
+    positions = {index: obj.position for index, obj in enumerate(canvas.objects) if obj.position is not None}
+    if not positions:
+        return {}
+    step = 1 if scale else grid
+    origin_x = min(x for x, _ in positions.values())
+    origin_y = min(y for _, y in positions.values())
+    snapped = {index: [grid_value(x, origin_x, grid) * step, grid_value(y, origin_y, grid) * step]
+               for index, (x, y) in positions.items()}
+    ports = {}
+    for index in sorted(snapped, key=lambda index: (positions[index][0], index)):
+        group = PORT_CLASSES.get(canvas.objects[index].name)
+        if group is None:
+            continue
+        previous = ports.get(group)
+        if previous is not None and snapped[index][0] <= previous:
+            snapped[index][0] = previous + 1
+        ports[group] = snapped[index][0]
+    return snapped
+
+# Objects whose relative creation order matters even without a connection
+# between them: Pd schedules unconnected DSP objects in creation order, so a
+# delwrite~ created before its delread~ (or s~ before r~, throw~ before catch~,
+# tabwrite~ before tabread~) runs first and the other side sees no extra block
+# of delay, and loadbangs fire in creation order. Subpatches hold such objects
+ORDER_SENSITIVE = {
+    "s~", "send~", "r~", "receive~", "throw~", "catch~", "delwrite~", "delread~", "delread4~", "vd~",
+    "tabwrite~", "tabread~", "tabread4~", "tabplay~", "tabsend~", "tabreceive~", "tabosc4~", "loadbang",
+}
+
+# For every object, the set (as a bit mask) of objects it feeds, directly or not
+def reachability(successors):
+    reach = []
+    for start in range(len(successors)):
+        seen, stack = 0, [start]
+        while stack:
+            for sink in successors[stack.pop()]:
+                if not seen >> sink & 1:
+                    seen |= 1 << sink
+                    stack.append(sink)
+        reach.append(seen)
+    return reach
+
+# Object indices in topological order of the connections: each object after
+# the objects feeding it, ties broken by the original index. Objects with no
+# path between them keep their original relative order, since Pd uses creation
+# order to schedule them; a canvas where that cannot be done (or with a
+# feedback loop) keeps its original order altogether
+def topological_order(canvas):
+    count = len(canvas.objects)
+    successors = [set() for _ in range(count)]
+    for source, _, sink, _ in canvas.iter_connections():
+        if source != sink and 0 <= source < count and 0 <= sink < count:
+            successors[source].add(sink)
+    reach = reachability(successors)
+    before = [set(sinks) for sinks in successors]
+    for first in range(count):
+        for second in range(first + 1, count):
+            if not (reach[first] >> second & 1 or reach[second] >> first & 1):
+                before[first].add(second)
+    indegree = [0] * count
+    for sinks in before:
+        for sink in sinks:
+            indegree[sink] += 1
+    ready = [index for index in range(count) if indegree[index] == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        index = heapq.heappop(ready)
+        order.append(index)
+        for sink in before[index]:
+            indegree[sink] -= 1
+            if indegree[sink] == 0:
+                heapq.heappush(ready, sink)
+    return order if len(order) == count else list(range(count))
+
+def round_number(atom, digits):
+    try:
+        return f"{float(atom):.{digits}g}"
+    except ValueError:
+        return atom
+
+# Every saved value of an array, by index, as the #A records list them
+def array_values(obj):
+    values = {}
+    for record in obj.extras:
+        if record.chunk == "#A":
+            start = int(record.atoms[1])
+            for offset, atom in enumerate(record.atoms[2:]):
+                values[start + offset] = atom
+    return values
+
+# An array's #A records rewritten without the zeros Pd fills in anyway and,
+# with digits, values rounded to that many significant digits (lossy)
+def array_records(obj, digits=None):
+    values = array_values(obj)
+    if digits is not None:
+        values = {index: round_number(atom, digits) for index, atom in values.items()}
+    records = []
+    previous = None
+    for index in sorted(index for index, atom in values.items() if not same_number(atom, 0)):
+        if previous is None or index - previous > ZERO_RUN:
+            records.append(["#A", str(index)])
+        else:
+            records[-1].extend(["0"] * (index - previous - 1))
+        records[-1].append(values[index])
+        previous = index
+    return [PdRecord(tuple(record)) for record in records]
+
+def normalize_array(obj, digits=None):
+    if not any(record.chunk == "#A" for record in obj.extras):
+        return
+    try:
+        records = array_records(obj, digits)
+    except (ValueError, IndexError):
+        return
+    # The rewritten data takes the place of the first #A record
+    extras = []
+    for record in obj.extras:
+        if record.chunk != "#A":
+            extras.append(record)
+        elif records is not None:
+            extras.extend(records)
+            records = None
+    obj.extras = extras
+
+# A canvas whose layout is visible elsewhere (graph-on-parent areas and array
+# graphs) keeps its coordinates
+def keeps_layout(canvas):
+    return (canvas.header.selector == "graph"
+            or any(isinstance(item, PdRecord) and item.selector == "coords" for item in canvas.body))
+
+def normalize_canvas(canvas, grid, reorder, scale=False, array_digits=None):
+    if canvas.header.chunk == "#N" and len(canvas.header.atoms) >= 7:
+        canvas.header = PdRecord(canvas.header.atoms[:2] + DEFAULT_WINDOW + canvas.header.atoms[6:])
+
+    positions = {} if keeps_layout(canvas) else canvas_positions(canvas, grid, scale)
+    for index, obj in enumerate(canvas.objects):
+        if obj.kind == "array":
+            normalize_array(obj, array_digits)
+        atoms = reset_gui_args(obj, obj.record.atoms)
+        if index in positions:
+            atoms = atoms[:2] + tuple(str(value) for value in positions[index]) + atoms[4:]
+        if atoms != obj.record.atoms:
+            obj.record = PdRecord(atoms)
+
+    order = topological_order(canvas) if reorder else list(range(len(canvas.objects)))
+    new_index = {old: new for new, old in enumerate(order)}
+    # Records before the first object (such as #X declare) stay in front;
+    # connections and everything else follow the objects in their original order
+    leading, trailing = [], []
+    records = leading
+    connections = array("i")
+    for item in canvas.body:
+        if isinstance(item, PdObject):
+            records = trailing
+            continue
+        if item.chunk == "#X" and item.selector == "connect":
+            source, outlet, sink, inlet = (int(atom) for atom in item.atoms[2:6])
+            source, sink = new_index[source], new_index[sink]
+            item = PdRecord(("#X", "connect", str(source), str(outlet), str(sink), str(inlet)))
+            connections.extend((source, outlet, sink, inlet))
+        records.append(item)
+    canvas.objects = [canvas.objects[index] for index in order]
+    canvas.body = leading + canvas.objects + trailing
+    canvas.connections = connections
+
+# Rewrite a patch in canonical form: window geometry reset, positions snapped
+# to a grid (with scale, written in grid units), GUI objects stripped of default
+# parameters, saved arrays without their zeros (with array_digits, rounded) and
+# (with reorder) objects in topological order with the connections renumbered
+# to match. The result opens in Pd as the same patch. A reordering that moves
+# order-sensitive objects is retried without reordering; patches that do not
+# validate, or whose rewrite still does not check out as the same patch, are
+# returned unchanged
+def normalize_patch(text, grid=GRID, reorder=True, scale=False, array_digits=None):
+    patch = parse(text)
+    if patch.errors or validate_patch(text, patch).errors:
+        return text
+    for canvas in list(patch.iter_canvases()):
+        normalize_canvas(canvas, grid, reorder, scale, array_digits)
+    normalized = serialize(patch)
+    if same_patch(text, normalized, array_digits):
+        return normalized
+    return normalize_patch(text, grid, False, scale, array_digits) if reorder else text
+
+# Token counts of a patch before and after normalization, measured on the
+# cleaned text the dataset is built from
+def token_savings(text, normalized, tokenizer=None):
+    before, after = clean_content(text), clean_content(normalized)
+    if tokenizer is None:
+        counts = [estimate_tokens(before), estimate_tokens(after)]
+    else:
+        counts = [len(encoding.ids) for encoding in tokenizer.encode_batch([before, after])]
+    return {"tokens_before": counts[0], "tokens_after": counts[1], "saved": counts[0] - counts[1]}
+
+# What a canvas contains regardless of object order: its object classes and
+# its connections between them
+def canvas_signature(canvas):
+    names = sorted(obj.name for obj in canvas.objects)
+    wires = sorted((canvas.objects[source].name, outlet, canvas.objects[sink].name, inlet)
+                   for source, outlet, sink, inlet in canvas.iter_connections())
+    return names, wires
+
+# The non-zero saved values of a canvas's arrays, optionally rounded
+def canvas_arrays(canvas, digits=None):
+    arrays = []
+    for obj in canvas.objects:
+        if obj.kind == "array":
+            values = array_values(obj)
+            if digits is not None:
+                values = {index: round_number(atom, digits) for index, atom in values.items()}
+            arrays.append((obj.args, sorted((index, atom) for index, atom in values.items() if not same_number(atom, 0))))
+    return sorted(arrays)
+
+# The creation order of a canvas's order-sensitive objects and subpatches
+def canvas_order(canvas):
+    return [(obj.name, obj.args) for obj in canvas.objects
+            if obj.subpatch is not None or obj.name in ORDER_SENSITIVE]
+
+# Check that the normalized patch is the same patch: it still validates, and
+# it has the same canvases holding the same objects, connections and array
+# data (rounded to array_digits when the normalization rounded it), with the
+# order-sensitive objects still created in the same order. Reordering moves
+# subpatches too, so canvases are compared as a set rather than in order
+def same_patch(text, normalized, array_digits=None):
+    original, result = parse(text), parse(normalized)
+    if validate_patch(normalized, result).errors:
+        return False
+    try:
+        before = sorted((canvas_signature(canvas), canvas_order(canvas), canvas_arrays(canvas, array_digits))
+                        for canvas in original.iter_canvases())
+        after = sorted((canvas_signature(canvas), canvas_order(canvas), canvas_arrays(canvas))
+                       for canvas in result.iter_canvases())
+    except (ValueError, IndexError):
+        return False
+    return before == after
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Canonicalize Pd patches and report the tokens saved")
+    parser.add_argument("source", help="A .pd file or a folder of patches (and .zip archives)")
+    parser.add_argument("--output-dir", default=None, help="Write the normalized patches here, keeping their names")
+    parser.add_argument("--report", default=None, help="JSONL file with the token counts of every patch")
+    parser.add_argument("--tokenizer", default=None, help="Tokenizer JSON for exact counts (default: estimate)")
+    parser.add_argument("--max-tokens", type=int, default=2048, help="Budget to count patches against")
+    parser.add_argument("--grid", type=int, default=GRID)
+    parser.add_argument("--keep-order", action="store_true", help="Keep the original object order")
+    parser.add_argument("--scale", action="store_true",
+                        help="Write positions in grid units rather than pixels (multiply by --grid to restore the layout)")
+    parser.add_argument("--array-digits", type=int, default=None,
+                        help="Round saved array values to this many significant digits (lossy)")
+    args = parser.parse_args(argv)
+
+    tokenizer = None
+    if args.tokenizer:
+        from tokenizers import Tokenizer
+
+        tokenizer = Tokenizer.from_file(args.tokenizer)
+    errors = []
+    sources = walk_corpus(args.source, errors) if os.path.isdir(args.source) else [
+        ref for ref in walk_corpus(os.path.dirname(os.path.abspath(args.source)), errors)
+        if ref.path == os.path.abspath(args.source)
+    ]
+    report = open(args.report, "w", encoding="utf-8") if args.report else None
+    totals = {"patches": 0, "changed": 0, "unchanged": 0, "tokens_before": 0, "tokens_after": 0,
+              "over_budget_before": 0, "over_budget_after": 0}
+    try:
+        for source, content, _, error in load_sources(sources):
+            if error is not None:
+                errors.append({"path": source.key, "error": error})
+                continue
+            normalized = normalize_patch(content, args.grid, not args.keep_order, args.scale, args.array_digits)
+            counts = token_savings(content, normalized, tokenizer)
+            totals["patches"] += 1
+            totals["changed" if normalized != content else "unchanged"] += 1
+            totals["tokens_before"] += counts["tokens_before"]
+            totals["tokens_after"] += counts["tokens_after"]
+            totals["over_budget_before"] += counts["tokens_before"] >= args.max_tokens
+            totals["over_budget_after"] += counts["tokens_after"] >= args.max_tokens
+            if report is not None:
+                report.write(json.dumps({"path": source.key, **counts}, ensure_ascii=False) + "\n")
+            if args.output_dir:
+                relative = os.path.basename(source.name) if not os.path.isdir(args.source) else \
+                    os.path.relpath(source.key.replace("!", os.sep), args.source)
+                output_path = os.path.join(args.output_dir, relative)
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with open(output_path, "w", encoding="utf-8") as file:
+                    file.write(normalized)
+    finally:
+        if report is not None:
+            report.close()
+
+    saved = totals["tokens_before"] - totals["tokens_after"]
+    share = saved / totals["tokens_before"] if totals["tokens_before"] else 0
+    print(f"Normalized {totals['changed']} of {totals['patches']} patches: {totals['tokens_before']} -> "
+          f"{totals['tokens_after']} tokens ({share:.1%} saved)")
+    print(f"Over the {args.max_tokens}-token budget: {totals['over_budget_before']} before, "
+          f"{totals['over_budget_after']} after")
+    for error in errors:
+        print(f"Skipped {error['path']}: {error['error']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+import re
+from array import array
+
+# A record runs up to the next unescaped ';' and keeps the whitespace after it,
+# so joining the raw text of every record gives back the original file exactly.
+# An unterminated tail (truncated or malformed output) becomes a final record
+RECORD_RE = re.compile(r"[^;\\]*(?:\\.[^;\\]*)*(?:;\s*|\\?\Z)", re.S)
+ATOM_RE = re.compile(r"(?:\\.|[^\s\\])+|\\", re.S)
+
+# #X selectors that add an object to the current canvas and so take an index
+# in its #X connect records
+OBJECT_SELECTORS = frozenset(("obj", "msg", "floatatom", "symbolatom", "listbox", "text", "array", "scalar"))
+# #X selectors that close the current canvas and add it to its parent as an object
+CLOSE_SELECTORS = frozenset(("restore", "pop"))
+# Records that modify the object just before them rather than standing alone
+ATTACHED_SELECTORS = frozenset(("f",))
+POSITIONED_SELECTORS = frozenset(("obj", "msg", "floatatom", "symbolatom", "listbox", "text", "restore"))
+
+LINE_WIDTH = 60
+
+class PdRecord:
+    __slots__ = ("atoms", "raw")
+
+    def __init__(self, atoms, raw=None):
+        self.atoms = atoms
+        self.raw = raw
+
+    @property
+    def chunk(self):
+        return self.atoms[0] if self.atoms else ""
+
+    @property
+    def selector(self):
+        return self.atoms[1] if len(self.atoms) > 1 else ""
+
+    @property
+    def terminated(self):
+        return self.raw is None or self.raw.rstrip().endswith(";")
+
+    def text(self):
+        return self.raw if self.raw is not None else format_record(self.atoms)
+
+    def __repr__(self):
+        return f"PdRecord({' '.join(self.atoms)!r})"
+
+class PdObject:
+    __slots__ = ("record", "subpatch", "extras")
+
+    # record is None only for a subpatch whose #X restore never arrived
+
+    def __init__(self, record, subpatch=None):
+        self.record = record
+        self.subpatch = subpatch
+        self.extras = []
+
+    @property
+    def kind(self):
+        return self.record.selector
+
+    # The class name Pd instantiates: the first word of an obj box, "pd" or
+    # "graph" for a subpatch, or the box kind for messages, atoms and comments
+    @property
+    def name(self):
+        atoms = self.record.atoms
+        if self.kind in ("obj", "restore"):
+            return atoms[4] if len(atoms) > 4 else ("pd" if self.kind == "restore" else "")
+        return self.kind
+
+    @property
+    def args(self):
+        atoms = self.record.atoms
+        if self.kind in ("obj", "restore"):
+            return atoms[5:]
+        if self.kind in POSITIONED_SELECTORS:
+            return atoms[4:]
+        return atoms[2:]
+
+    @property
+    def position(self):
+        if self.kind not in POSITIONED_SELECTORS or len(self.record.atoms) < 4:
+            return None
+        try:
+            return float(self.record.atoms[2]), float(self.record.atoms[3])
+        except ValueError:
+            return None
+
+    def __repr__(self):
+        return f"PdObject({self.name!r}, {' '.join(self.args)!r})"
+
+class PdCanvas:
+    __slots__ = ("header", "parent", "objects", "connections", "body")
+
+    def __init__(self, header, parent=None):
+        self.header = header
+        self.parent = parent
+        self.objects = []
+        # Flat (source, outlet, sink, inlet) quadruples, one per #X connect
+        self.connections = array("i")
+        self.body = []
+
+    def iter_connections(self):
+        connections = self.connections
+        for i in range(0, len(connections), 4):
+            yield connections[i], connections[i + 1], connections[i + 2], connections[i + 3]
+
+    def iter_records(self):
+        if self.header is not None:
+            yield self.header
+        for item in self.body:
+            if isinstance(item, PdObject):
+                if item.subpatch is not None:
+                    yield from item.subpatch.iter_records()
+                if item.record is not None:
+                    yield item.record
+                yield from item.extras
+            else:
+                yield item
+
+    def iter_canvases(self):
+        yield self
+        for item in self.body:
+            if isinstance(item, PdObject) and item.subpatch is not None:
+                yield from item.subpatch.iter_canvases()
+
+class PdPatch:
+    __slots__ = ("prelude", "root", "errors")
+
+    def __init__(self):
+        # Records before the first #N canvas, such as #N struct declarations
+        self.prelude = []
+        self.root = None
+        self.errors = []
+
+    def iter_records(self):
+        yield from self.prelude
+        if self.root is not None:
+            yield from self.root.iter_records()
+
+    def iter_canvases(self):
+        if self.root is not None:
+            yield from self.root.iter_canvases()
+
+    def iter_objects(self):
+        for canvas in self.iter_canvases():
+            yield from canvas.objects
+
+def iter_raw_records(text):
+    for match in RECORD_RE.finditer(text):
+        raw = match.group()
+        if raw:
+            yield raw
+
+def parse_atoms(raw):
+    body = raw.rstrip()
+    if body.endswith(";") and not body.endswith("\\;"):
+        body = body[:-1]
+    if "\\" not in body:
+        return tuple(body.split())
+    return tuple(ATOM_RE.findall(body))
+
+def parse_record(raw):
+    return PdRecord(parse_atoms(raw), raw)
+
+def parse(text):
+    patch = PdPatch()
+    canvas = None
+    for raw in iter_raw_records(text):
+        record = parse_record(raw)
+        chunk, selector = record.chunk, record.selector
+
+        if chunk == "#N" and selector == "canvas" or chunk == "#X" and selector == "graph":
+            subcanvas = PdCanvas(record, canvas)
+            if canvas is None:
+                patch.root = subcanvas
+            canvas = subcanvas
+            continue
+        if canvas is None:
+            patch.prelude.append(record)
+            continue
+
+        if chunk == "#X" and selector in CLOSE_SELECTORS:
+            if canvas.parent is None:
+                patch.errors.append(f"#X {selector} without an open subpatch")
+                canvas.body.append(record)
+                continue
+            obj = PdObject(record, canvas)
+            canvas = canvas.parent
+            canvas.objects.append(obj)
+            canvas.body.append(obj)
+        elif chunk == "#X" and selector in OBJECT_SELECTORS:
+            obj = PdObject(record)
+            canvas.objects.append(obj)
+            canvas.body.append(obj)
+        elif (chunk == "#A" or chunk == "#X" and selector in ATTACHED_SELECTORS) \
+                and canvas.body and isinstance(canvas.body[-1], PdObject):
+            canvas.body[-1].extras.append(record)
+        else:
+            if chunk == "#X" and selector == "connect":
+                try:
+                    source, outlet, sink, inlet = (int(atom) for atom in record.atoms[2:6])
+                except ValueError:
+                    patch.errors.append(f"Malformed connect record: {' '.join(record.atoms)}")
+                else:
+                    canvas.connections.extend((source, outlet, sink, inlet))
+            elif record.atoms and not chunk.startswith("#"):
+                patch.errors.append(f"Unexpected text outside a record: {' '.join(record.atoms)[:40]}")
+            canvas.body.append(record)
+
+    # Keep unclosed subpatches in the tree so their records still serialize. They
+    # have no restore record and so take no object index in the parent
+    while canvas is not None and canvas.parent is not None:
+        patch.errors.append("Subpatch is missing its #X restore")
+        canvas.parent.body.append(PdObject(None, canvas))
+        canvas = canvas.parent
+    if patch.root is None:
+        patch.errors.append("Missing #N canvas header")
+    return patch
+
+def serialize(patch):
+    return "".join(record.text() for record in patch.iter_records())
+
+# Format atoms the way Pd writes them, wrapping long records onto continuation lines
+def format_record(atoms):
+    lines = []
+    line = ""
+    for atom in atoms:
+        if line and len(line) + 1 + len(atom) > LINE_WIDTH:
+            lines.append(line)
+            line = atom
+        else:
+            line = f"{line} {atom}" if line else atom
+    lines.append(line)
+    return "\n".join(lines) + ";\n"
+
+# Split streamed text into records as soon as each one is complete
+class RecordAssembler:
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        records = []
+        position = 0
+        for match in RECORD_RE.finditer(self.buffer):
+            raw = match.group()
+            # A record is only final once more text follows it: until then its
+            # trailing whitespace, or the character after a backslash, may still be arriving
+            if not raw or match.end() == len(self.buffer) or not raw.rstrip().endswith(";"):
+                break
+            records.append(parse_record(raw))
+            position = match.end()
+        self.buffer = self.buffer[position:]
+        return records
+
+    def flush(self):
+        records = [parse_record(raw) for raw in iter_raw_records(self.buffer)]
+        self.buffer = ""
+        return records
@@ -0,0 +1,148 @@
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import statistics
+import tempfile
+
+from pd_ingest import walk_corpus
+from pd_metrics import metrics, profiling, span
+from pd_parser import RecordAssembler
+from pd_validator import rank_candidates
+from pd_dedup import PatchDeduplicator, iter_deduplicated
+from processTrainingData import iter_pd_records, prepare_pd_files_data, save_to_jsonl
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TrainingData")
+DEFAULT_SCALES = [1, 10, 100]
+DEFAULT_WORK_DIR = "bench_corpora"
+MAX_TOKENS = 2048
+# Patches streamed through the generation path per run, in deltas of this many characters
+GENERATION_SAMPLE = 50
+STREAM_DELTA_CHARS = 16
+POSITION_RE = re.compile(r"^(#X (?:obj|msg|floatatom|symbolatom|listbox|text) )(\d+) ", re.M)
+
+# A synthetic corpus of scale copies of the source patches. Every copy after
+# the first has its boxes shifted, so the copies are different files with
+# different hashes, as a larger scrape would be, rather than exact duplicates
+def build_corpus(source, scale, work_dir):
+    corpus = os.path.join(work_dir, f"x{scale}")
+    sources = list(walk_corpus(source))
+    marker = os.path.join(corpus, ".complete")
+    if os.path.exists(marker):
+        with open(marker) as file:
+            if file.read() == f"{len(sources)}\n":
+                return corpus
+    shutil.rmtree(corpus, ignore_errors=True)
+    for copy in range(scale):
+        directory = os.path.join(corpus, f"{copy:03d}")
+        os.makedirs(directory, exist_ok=True)
+        for number, source_ref in enumerate(sources):
+            if source_ref.member is not None:
+                continue
+            with open(source_ref.path, "rb") as file:
+                data = file.read()
+            if copy:
+                text = data.decode("latin-1")
+                text = POSITION_RE.sub(lambda match: f"{match.group(1)}{int(match.group(2)) + copy} ", text)
+                data = text.encode("latin-1")
+            with open(os.path.join(directory, f"{number:05d}-{os.path.basename(source_ref.name)}"), "wb") as file:
+                file.write(data)
+    with open(marker, "w") as file:
+        file.write(f"{len(sources)}\n")
+    return corpus
+
+# Replay patches as if they were streamed from the API: assemble records from
+# small deltas, then validate and rank them the way generate_start does
+def generation_path(patches):
+    for patch in patches:
+        assembler = RecordAssembler()
+        for start in range(0, len(patch), STREAM_DELTA_CHARS):
+            assembler.feed(patch[start:start + STREAM_DELTA_CHARS])
+        assembler.flush()
+    return rank_candidates(patches)
+
+# One pass over the dataset build and generation path, each stage under its own span
+def run_pipeline(corpus, output_dir, workers):
+    errors = []
+    with span("bench.walk"):
+        sources = list(walk_corpus(corpus, errors))
+    with span("bench.tokenizer"):
+        tokenizer, texts = prepare_pd_files_data(corpus, MAX_TOKENS, workers, errors)
+    with span("bench.records"):
+        sourced = list(iter_pd_records(corpus, tokenizer, MAX_TOKENS, workers=workers, errors=errors, with_source=True))
+    records = [record for _, record in sourced]
+    # The synthetic copies are near-duplicates, so the JSONL stage writes every
+    # record rather than only the ones deduplication keeps
+    with span("bench.jsonl"):
+        save_to_jsonl(records, os.path.join(output_dir, "bench.jsonl"))
+    with span("bench.dedup"):
+        kept = sum(1 for _ in iter_deduplicated(sourced, PatchDeduplicator()))
+    with span("bench.generation"):
+        generation_path([text.split("\n\n", 1)[-1] for text in texts[:GENERATION_SAMPLE]])
+    return {"sources": len(sources), "records": len(records), "kept": kept, "errors": len(errors)}
+
+def benchmark(corpus, runs, workers):
+    stage_runs = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for _ in range(runs):
+            metrics.reset()
+            counts = run_pipeline(corpus, output_dir, workers)
+            for name, stats in metrics.snapshot()["spans"].items():
+                if name.startswith("bench."):
+                    stage_runs.setdefault(name[len("bench."):], []).append(stats["total"])
+    return {
+        "counts": counts,
+        "stages": {name: {"median": statistics.median(times), "min": min(times)} for name, times in stage_runs.items()},
+    }
+
+# Stages whose median grew by more than tolerance against the baseline run
+def regressions(results, baseline, tolerance):
+    slower = []
+    for scale, result in results.items():
+        for stage, stats in result["stages"].items():
+            previous = baseline.get(scale, {}).get("stages", {}).get(stage)
+            if previous and stats["median"] > previous["median"] * (1 + tolerance):
+                slower.append((scale, stage, previous["median"], stats["median"]))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the dataset build and generation path on scaled copies of the corpus")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--scales", type=lambda value: [int(scale) for scale in value.split(",")], default=DEFAULT_SCALES,
+                        help="Comma-separated corpus multipliers (default: 1,10,100)")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None, help="Ingestion worker processes (default: every core)")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR, help="Where the synthetic corpora are generated and kept")
+    parser.add_argument("--output", default=None, help="Write the results as JSON, e.g. to use as a later --baseline")
+    parser.add_argument("--baseline", default=None, help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown per stage before failing")
+    parser.add_argument("--profile", choices=["cprofile", "py-spy"], default=None)
+    parser.add_argument("--profile-output", default="pipeline_bench.prof")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with profiling(args.profile, args.profile_output):
+        for scale in args.scales:
+            corpus = args.corpus if scale == 1 else build_corpus(args.corpus, scale, args.work_dir)
+            result = results[str(scale)] = benchmark(corpus, args.runs, args.workers)
+            counts = result["counts"]
+            print(f"x{scale}: {counts['sources']} patches, {counts['records']} records "
+                  f"({counts['kept']} after deduplication), {counts['errors']} errors")
+            for stage, stats in result["stages"].items():
+                print(f"    {stage:<12} {stats['median'] * 1000:10.1f} ms median  {stats['min'] * 1000:10.1f} ms min")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            slower = regressions(results, json.load(file), args.tolerance)
+        for scale, stage, before, after in slower:
+            print(f"Regression at x{scale} in {stage}: {before * 1000:.1f} ms -> {after * 1000:.1f} ms")
+        return 1 if slower else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
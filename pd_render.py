@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import struct
+import argparse
+import tempfile
+import subprocess
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from pd_parser import PdRecord, parse, serialize
+
+SAMPLE_RATE = 44100
+RENDER_SECONDS = 5
+SILENCE_DB = -60
+# Abstraction that stands in for dac~ in the render copy of a patch: up to
+# eight inlets, each thrown to the render bus of the channel named by its argument
+RENDER_DAC = "render-dac~"
+RENDER_DAC_INLETS = 8
+
+# Harness opened after the patch: starts DSP, records channels 1 and 2 of the
+# render bus to a float WAV and quits Pd after the requested logical time
+HARNESS_PATCH = """#N canvas 0 50 450 300 12;
+#X obj 20 20 loadbang;
+#X msg 20 50 \\; pd dsp 1 \\; render-writer open -bytes 4 {wav_path} \\; render-writer start;
+#X obj 20 120 catch~ render-1;
+#X obj 160 120 catch~ render-2;
+#X obj 20 170 writesf~ 2;
+#X obj 300 120 r render-writer;
+#X obj 300 20 delay {milliseconds};
+#X msg 300 50 \\; render-writer stop \\; pd quit;
+#X connect 0 0 1 0;
+#X connect 2 0 4 0;
+#X connect 3 0 4 1;
+#X connect 5 0 4 0;
+#X connect 0 0 6 0;
+#X connect 6 0 7 0;
+"""
+
+def render_dac_abstraction():
+    lines = ["#N canvas 0 50 450 300 12;\n"]
+    for inlet in range(RENDER_DAC_INLETS):
+        lines.append(f"#X obj {20 + 100 * inlet} 20 inlet~;\n")
+    for inlet in range(RENDER_DAC_INLETS):
+        lines.append(f"#X obj {20 + 100 * inlet} 60 throw~ render-\\${inlet + 1};\n")
+    for inlet in range(RENDER_DAC_INLETS):
+        lines.append(f"#X connect {inlet} 0 {RENDER_DAC_INLETS + inlet} 0;\n")
+    return "".join(lines)
+
+# Copy of the patch with every dac~ sending to the render bus instead of the sound card
+def reroute_dac(text):
+    patch = parse(text)
+    for obj in patch.iter_objects():
+        if obj.record is not None and obj.kind == "obj" and obj.name == "dac~":
+            channels = obj.args or ("1", "2")
+            obj.record = PdRecord((*obj.record.atoms[:4], RENDER_DAC, *channels))
+    return serialize(patch)
+
+# Read a PCM or float WAV into per-channel float arrays
+def read_wav(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError(f"{path} is not a WAV file")
+    position = 12
+    fmt = samples = None
+    while position + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, position)
+        body = data[position + 8:position + 8 + size]
+        if chunk_id == b"fmt ":
+            fmt = list(struct.unpack_from("<HHIIHH", body))
+            if fmt[0] == 0xFFFE:
+                # WAVE_FORMAT_EXTENSIBLE keeps the real format at the start of its subformat GUID
+                fmt[0] = struct.unpack_from("<H", body, 24)[0]
+        elif chunk_id == b"data":
+            samples = body
+        position += 8 + size + (size & 1)
+    if fmt is None or samples is None:
+        raise ValueError(f"{path} has no fmt or data chunk")
+    format_tag, channels, sample_rate, _, _, bits = fmt
+    if format_tag == 3 and bits == 32:
+        values = array("f", samples[:len(samples) // 4 * 4])
+        if sys.byteorder == "big":
+            values.byteswap()
+    elif format_tag == 1 and bits == 16:
+        values = array("f", (value / 32768 for value in array("h", samples[:len(samples) // 2 * 2])))
+    elif format_tag == 1 and bits == 24:
+        values = array("f", (int.from_bytes(samples[i:i + 3], "little", signed=True) / 8388608
+                             for i in range(0, len(samples) - 2, 3)))
+    else:
+        raise ValueError(f"Unsupported WAV encoding: format {format_tag}, {bits} bits")
+    return sample_rate, [values[channel::channels] for channel in range(channels)]
+
+def write_wav(path, sample_rate, channels):
+    frames = array("f", (sample for frame in zip(*channels) for sample in frame))
+    if sys.byteorder == "big":
+        frames.byteswap()
+    body = frames.tobytes()
+    with open(path, "wb") as file:
+        file.write(b"RIFF" + struct.pack("<I", 36 + len(body)) + b"WAVE")
+        file.write(b"fmt " + struct.pack("<IHHIIHH", 16, 3, len(channels), sample_rate,
+                                         sample_rate * 4 * len(channels), 4 * len(channels), 32))
+        file.write(b"data" + struct.pack("<I", len(body)) + body)
+
+# Loudness and sanity figures for rendered audio
+def analyze(channels):
+    peak = 0.0
+    total = 0.0
+    count = 0
+    nan = clipped = 0
+    for samples in channels:
+        for sample in samples:
+            if sample != sample or sample in (math.inf, -math.inf):
+                nan += 1
+                continue
+            magnitude = abs(sample)
+            if magnitude > 1.0:
+                clipped += 1
+            if magnitude > peak:
+                peak = magnitude
+            total += sample * sample
+            count += 1
+    rms = math.sqrt(total / count) if count else 0.0
+    rms_db = 20 * math.log10(rms) if rms > 0 else -math.inf
+    samples = sum(len(samples) for samples in channels)
+    return {
+        "peak": round(peak, 6),
+        "rms_db": round(rms_db, 2) if rms > 0 else None,
+        "silent": rms_db < SILENCE_DB,
+        "nan": nan,
+        "clipped": round(clipped / samples, 6) if samples else 0.0,
+    }
+
+# Render with Pd itself in batch mode, which runs DSP as fast as the CPU allows
+# without opening a sound card
+def render_with_pd(patch_path, seconds, pd_path, work_dir):
+    with open(patch_path, encoding="utf-8", errors="replace") as file:
+        text = file.read()
+    render_path = os.path.join(work_dir, "render-patch.pd")
+    with open(render_path, "w", encoding="utf-8") as file:
+        file.write(reroute_dac(text))
+    with open(os.path.join(work_dir, f"{RENDER_DAC}.pd"), "w") as file:
+        file.write(render_dac_abstraction())
+    wav_path = os.path.join(work_dir, "render.wav")
+    harness_path = os.path.join(work_dir, "render-harness.pd")
+    with open(harness_path, "w") as file:
+        file.write(HARNESS_PATCH.format(wav_path=wav_path, milliseconds=int(seconds * 1000)))
+
+    args = [pd_path, "-nogui", "-batch", "-r", str(SAMPLE_RATE), "-path", os.path.dirname(os.path.abspath(patch_path)),
+            "-open", render_path, "-open", harness_path]
+    completed = subprocess.run(args, cwd=work_dir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, timeout=max(60, seconds * 20))
+    if not os.path.exists(wav_path):
+        output = completed.stdout.decode("utf-8", "replace").strip().splitlines()
+        raise RuntimeError(f"Pd exited with status {completed.returncode} without rendering: {' | '.join(output[-3:])}")
+    return read_wav(wav_path)
+
+class UnsupportedPatch(Exception):
+    pass
+
+# Offline stand-in for machines without Pd: evaluates the signal graph of the
+# top-level canvas for a handful of vanilla DSP objects, driven only by their
+# creation arguments (messages, clocks and subpatches are not simulated).
+# Patches using any other tilde object are reported as unsupported
+def render_standin(patch_path, seconds):
+    with open(patch_path, encoding="utf-8", errors="replace") as file:
+        patch = parse(file.read())
+    if patch.root is None:
+        raise UnsupportedPatch("no canvas")
+    objects = patch.root.objects
+    inputs = {}
+    for source, outlet, sink, inlet in patch.root.iter_connections():
+        if 0 <= source < len(objects) and 0 <= sink < len(objects) and objects[source].name.endswith("~"):
+            inputs.setdefault((sink, inlet), []).append(source)
+
+    length = int(seconds * SAMPLE_RATE)
+    signals = {}
+    rng = random.Random(0)
+
+    def argument(obj, index, default=0.0):
+        try:
+            return float(obj.args[index])
+        except (IndexError, ValueError):
+            return default
+
+    def signal_input(index, inlet, default):
+        sources = inputs.get((index, inlet))
+        if not sources:
+            return None if default is None else [default] * length
+        summed = [0.0] * length
+        for source in sources:
+            for i, value in enumerate(evaluate(source)):
+                summed[i] += value
+        return summed
+
+    def evaluate(index):
+        if index in signals:
+            return signals[index]
+        signals[index] = [0.0] * length  # breaks feedback loops, which need delwrite~ in Pd anyway
+        obj = objects[index]
+        name = obj.name
+        if name in ("osc~", "phasor~"):
+            frequency = signal_input(index, 0, argument(obj, 0))
+            phase = 0.0
+            output = []
+            for value in frequency:
+                output.append(math.cos(2 * math.pi * phase) if name == "osc~" else phase)
+                phase = (phase + value / SAMPLE_RATE) % 1.0
+        elif name == "cos~":
+            output = [math.cos(2 * math.pi * value) for value in signal_input(index, 0, 0.0)]
+        elif name == "noise~":
+            output = [rng.uniform(-1, 1) for _ in range(length)]
+        elif name == "sig~":
+            output = signal_input(index, 0, argument(obj, 0))
+        elif name in ("*~", "+~", "-~", "/~", "max~", "min~"):
+            left = signal_input(index, 0, 0.0)
+            right = signal_input(index, 1, argument(obj, 0, 1.0 if name in ("*~", "/~") else 0.0))
+            operation = {
+                "*~": lambda a, b: a * b, "+~": lambda a, b: a + b, "-~": lambda a, b: a - b,
+                "/~": lambda a, b: a / b if b else 0.0, "max~": max, "min~": min,
+            }[name]
+            output = [operation(a, b) for a, b in zip(left, right)]
+        elif name in ("lop~", "hip~"):
+            source = signal_input(index, 0, 0.0)
+            coefficient = 2 * math.pi * argument(obj, 0) / SAMPLE_RATE
+            output = []
+            last = 0.0
+            if name == "lop~":
+                coefficient = min(max(coefficient, 0.0), 1.0)
+                for value in source:
+                    last += coefficient * (value - last)
+                    output.append(last)
+            else:
+                coefficient = min(max(1 - coefficient, 0.0), 1.0)
+                for value in source:
+                    new = value + coefficient * last
+                    output.append(new - last)
+                    last = new
+        elif name == "clip~":
+            low, high = argument(obj, 0), argument(obj, 1)
+            output = [min(max(value, low), high) for value in signal_input(index, 0, 0.0)]
+        else:
+            raise UnsupportedPatch(f"{name} is not simulated")
+        signals[index] = output
+        return output
+
+    channels = [[0.0] * length, [0.0] * length]
+    for index, obj in enumerate(objects):
+        if obj.record is None or not obj.name.endswith("~"):
+            continue
+        if obj.name != "dac~":
+            evaluate(index)
+            continue
+        for inlet in range(max(len(obj.args), 2)):
+            sources = signal_input(index, inlet, None)
+            target = int(argument(obj, inlet, inlet + 1)) - 1
+            if sources is not None and target in (0, 1):
+                for i, value in enumerate(sources):
+                    channels[target][i] += value
+    return SAMPLE_RATE, [array("f", channel) for channel in channels]
+
+# Render one patch and score it. dsp_load is render time over audio time:
+# above 1.0 the patch could not keep up in real time on this machine
+def evaluate_patch(patch_path, seconds=RENDER_SECONDS, pd_path=None, wav_dir=None):
+    result = {"path": patch_path, "seconds": seconds, "renderer": "pd" if pd_path else "standin"}
+    work_dir = tempfile.mkdtemp(prefix="pd-render-")
+    started = time.perf_counter()
+    try:
+        if pd_path:
+            sample_rate, channels = render_with_pd(patch_path, seconds, pd_path, work_dir)
+        else:
+            sample_rate, channels = render_standin(patch_path, seconds)
+        render_seconds = time.perf_counter() - started
+    except (OSError, ValueError, RuntimeError, subprocess.TimeoutExpired, UnsupportedPatch) as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result["render_seconds"] = round(render_seconds, 4)
+    result["dsp_load"] = round(render_seconds / seconds, 4) if seconds else None
+    result.update(analyze(channels))
+    result["ok"] = not result["silent"] and not result["nan"] and result["clipped"] < 0.01
+    if wav_dir is not None:
+        os.makedirs(wav_dir, exist_ok=True)
+        wav_path = os.path.join(wav_dir, os.path.splitext(os.path.basename(patch_path))[0] + ".wav")
+        write_wav(wav_path, sample_rate, channels)
+        result["wav"] = wav_path
+    return result
+
+def iter_patch_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    if file.endswith(".pd") and not file.startswith(RENDER_DAC):
+                        yield os.path.join(root, file)
+        else:
+            yield path
+
+# Render patches over a process pool, yielding results as they finish in input order
+def evaluate_patches(patch_paths, seconds=RENDER_SECONDS, pd_path=None, workers=None, wav_dir=None):
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(evaluate_patch, path, seconds, pd_path, wav_dir) for path in patch_paths]
+        for future in futures:
+            yield future.result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render generated patches offline and score the audio")
+    parser.add_argument("paths", nargs="+", help="Patch files or folders of patches (e.g. a pd_batch output folder)")
+    parser.add_argument("--seconds", type=float, default=RENDER_SECONDS)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--pd", default=shutil.which("pd"), help="Pd executable (default: pd on PATH)")
+    parser.add_argument("--standin", action="store_true", help="Use the built-in stand-in renderer even when Pd is installed")
+    parser.add_argument("--results", default="render_results.jsonl")
+    parser.add_argument("--wav-dir", default=None, help="Keep the rendered audio as WAV files in this folder")
+    args = parser.parse_args(argv)
+
+    pd_path = None if args.standin else args.pd
+    if pd_path is None:
+        print("Pd not found; rendering with the stand-in, which only simulates basic DSP objects")
+    results = []
+    with open(args.results, "w", encoding="utf-8") as results_file:
+        for result in evaluate_patches(iter_patch_paths(args.paths), args.seconds, pd_path, args.workers, args.wav_dir):
+            results_file.write(json.dumps(result) + "\n")
+            results.append(result)
+
+    rendered = [result for result in results if "error" not in result]
+    passed = sum(1 for result in rendered if result["ok"])
+    print(f"Rendered {len(rendered)}/{len(results)} patches, {passed} passed; results in {args.results}")
+    if rendered:
+        loads = sorted(result["dsp_load"] for result in rendered)
+        print(f"DSP load: median {loads[len(loads) // 2]:.3f}, max {loads[-1]:.3f}; "
+              f"silent {sum(result['silent'] for result in rendered)}, with NaN {sum(bool(result['nan']) for result in rendered)}, "
+              f"clipping {sum(result['clipped'] >= 0.01 for result in rendered)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,20 @@
+import os
+import json
+
+RESOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+resources = {}
+
+# JSON files shipped next to the scripts, read on first use and then kept, so
+# they load the same whatever the working directory is
+def load_json_resource(name):
+    if name not in resources:
+        with open(os.path.join(RESOURCE_DIR, name), "r", encoding="utf-8") as file:
+            resources[name] = json.load(file)
+    return resources[name]
+
+def random_prompts():
+    return load_json_resource("randomPrompts.json")["randomPrompts"]
+
+def witty_messages():
+    return load_json_resource("witty_loading_phases.json")["witty_messages"]
@@ -0,0 +1,201 @@
+import os
+import re
+import sys
+import json
+import math
+import mmap
+import heapq
+import argparse
+from array import array
+from collections import Counter, defaultdict
+
+from pd_parser import parse
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "retrieval_index")
+TITLE_PREFIX = "PureData Patch: "
+# Fine-tuning prompts in pd_files_prepared.jsonl end with this separator
+TITLE_SEPARATOR = " ->"
+WORD_RE = re.compile(r"[a-z0-9]+(?:~)?")
+TITLE_WEIGHT = 3
+K1 = 1.2
+B = 0.75
+
+# Everyday words in prompts mapped to the vanilla objects that usually implement them
+OBJECT_SYNONYMS = {
+    "sine": ["osc~"], "oscillator": ["osc~", "phasor~"], "saw": ["phasor~"], "sawtooth": ["phasor~"],
+    "noise": ["noise~"], "metronome": ["metro"], "bpm": ["metro"], "tempo": ["metro"],
+    "filter": ["lop~", "hip~", "bp~", "vcf~"], "lowpass": ["lop~"], "highpass": ["hip~"], "bandpass": ["bp~", "vcf~"],
+    "delay": ["delwrite~", "delread~", "vd~"], "echo": ["delwrite~", "vd~"], "envelope": ["vline~", "line~"],
+    "sample": ["tabread4~", "soundfiler"], "table": ["tabread4~", "tabwrite~"], "random": ["random"],
+    "midi": ["notein", "mtof"], "fm": ["osc~", "*~"], "am": ["*~"], "fft": ["rfft~", "fft~"],
+}
+
+def title_terms(title):
+    return WORD_RE.findall(title.lower())
+
+# Terms describing a patch: its title words (boosted), the classes of every
+# object it creates, and the words of its comments
+def patch_terms(title, text):
+    terms = title_terms(title) * TITLE_WEIGHT
+    for obj in parse(text).iter_objects():
+        if obj.record is None:
+            continue
+        if obj.name == "text":
+            terms.extend(WORD_RE.findall(" ".join(obj.args).lower()))
+        elif obj.name:
+            terms.append(obj.name.lower())
+    return terms
+
+def query_terms(prompt):
+    words = WORD_RE.findall(prompt.lower())
+    terms = list(words)
+    for word in words:
+        terms.extend(OBJECT_SYNONYMS.get(word, ()))
+    return terms
+
+def estimate_tokens(text):
+    # Pd code runs at roughly three characters per BPE token
+    return len(text) // 3 + 1
+
+def iter_jsonl_documents(path):
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            title = record["prompt"]
+            if title.startswith(TITLE_PREFIX):
+                title = title[len(TITLE_PREFIX):]
+            if title.endswith(TITLE_SEPARATOR):
+                title = title[:-len(TITLE_SEPARATOR)]
+            yield title, record["completion"].strip()
+
+def iter_folder_documents(folder_path):
+    for root, dirs, files in os.walk(folder_path):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".pd"):
+                with open(os.path.join(root, file), encoding="utf-8", errors="replace") as handle:
+                    yield file[:-3], handle.read().strip()
+
+# Write a BM25 index as flat binary arrays: postings sorted by term, each with
+# its document id and precomputed BM25 weight, and the patch texts in one blob
+# addressed by an offsets array, so a query only touches the postings of its terms
+def build_index(documents, index_dir=DEFAULT_INDEX_DIR):
+    os.makedirs(index_dir, exist_ok=True)
+    titles = []
+    doc_offsets = array("Q", [0])
+    term_frequencies = []
+    with open(os.path.join(index_dir, "docs.bin"), "wb") as docs_file:
+        for title, text in documents:
+            encoded = text.encode("utf-8")
+            docs_file.write(encoded)
+            doc_offsets.append(doc_offsets[-1] + len(encoded))
+            titles.append(title)
+            term_frequencies.append(Counter(patch_terms(title, text)))
+
+    lengths = [sum(frequencies.values()) for frequencies in term_frequencies]
+    average_length = sum(lengths) / len(lengths) if lengths else 0
+    postings = defaultdict(list)
+    for doc_id, frequencies in enumerate(term_frequencies):
+        for term, frequency in frequencies.items():
+            postings[term].append((doc_id, frequency))
+
+    vocabulary = {}
+    posting_docs = array("I")
+    posting_weights = array("f")
+    for term in sorted(postings):
+        entries = postings[term]
+        idf = math.log(1 + (len(titles) - len(entries) + 0.5) / (len(entries) + 0.5))
+        vocabulary[term] = [len(posting_docs), len(posting_docs) + len(entries)]
+        for doc_id, frequency in entries:
+            norm = K1 * (1 - B + B * lengths[doc_id] / average_length)
+            posting_docs.append(doc_id)
+            posting_weights.append(idf * frequency * (K1 + 1) / (frequency + norm))
+
+    for name, values in (("doc_offsets.bin", doc_offsets), ("posting_docs.bin", posting_docs),
+                         ("posting_weights.bin", posting_weights)):
+        with open(os.path.join(index_dir, name), "wb") as file:
+            values.tofile(file)
+    with open(os.path.join(index_dir, "index.json"), "w", encoding="utf-8") as file:
+        json.dump({"titles": titles, "vocabulary": vocabulary}, file, ensure_ascii=False)
+    return len(titles)
+
+def map_array(path, typecode):
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return memoryview(array(typecode))
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode) if typecode != "B" else memoryview(mapped)
+
+class RetrievalIndex:
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        with open(os.path.join(index_dir, "index.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        self.titles = meta["titles"]
+        self.vocabulary = meta["vocabulary"]
+        # Memory-mapped, so opening the index costs nothing until postings are read
+        self.docs = map_array(os.path.join(index_dir, "docs.bin"), "B")
+        self.doc_offsets = map_array(os.path.join(index_dir, "doc_offsets.bin"), "Q")
+        self.posting_docs = map_array(os.path.join(index_dir, "posting_docs.bin"), "I")
+        self.posting_weights = map_array(os.path.join(index_dir, "posting_weights.bin"), "f")
+
+    def document(self, doc_id):
+        return bytes(self.docs[self.doc_offsets[doc_id]:self.doc_offsets[doc_id + 1]]).decode("utf-8")
+
+    def search(self, prompt, k=5):
+        scores = defaultdict(float)
+        for term in set(query_terms(prompt)):
+            span = self.vocabulary.get(term)
+            if span is None:
+                continue
+            start, end = span
+            for doc_id, weight in zip(self.posting_docs[start:end], self.posting_weights[start:end]):
+                scores[doc_id] += weight
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    # Pick the highest-ranked patches that fit within token_budget together
+    def examples(self, prompt, k=3, token_budget=1500):
+        examples = []
+        for doc_id, _ in self.search(prompt, k * 4):
+            text = self.document(doc_id)
+            cost = estimate_tokens(text)
+            if cost > token_budget:
+                continue
+            examples.append((self.titles[doc_id], text))
+            token_budget -= cost
+            if len(examples) == k:
+                break
+        return examples
+
+retrieval_index = None
+
+# The shared index for the GUI, or None when it has not been built
+def get_retrieval_index(index_dir=DEFAULT_INDEX_DIR):
+    global retrieval_index
+    if retrieval_index is None and os.path.exists(os.path.join(index_dir, "index.json")):
+        retrieval_index = RetrievalIndex(index_dir)
+    return retrieval_index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the few-shot retrieval index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build")
+    build.add_argument("source", help="Dataset JSONL (prompt/completion records) or a folder of .pd files")
+    build.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    query = commands.add_parser("query")
+    query.add_argument("prompt")
+    query.add_argument("--index-dir", default=DEFAULT_INDEX_DIR)
+    query.add_argument("-k", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        documents = iter_folder_documents(args.source) if os.path.isdir(args.source) else iter_jsonl_documents(args.source)
+        count = build_index(documents, args.index_dir)
+        print(f"Indexed {count} patches in {args.index_dir}")
+    else:
+        index = RetrievalIndex(args.index_dir)
+        for doc_id, score in index.search(args.prompt, args.k):
+            print(f"{score:8.3f}  {index.titles[doc_id]}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,8 @@
 import scrapy
 import os
 import random
+import shutil
 import hashlib
-import time
 import zipfile
 
 from scrapy import signals
@@ -10,8 +10,12 @@ from scrapy.downloadermiddlewares.useragent import UserAgentMiddleware
 from scrapy.utils.project import get_project_settings
 from fake_useragent import UserAgentMiddleware as RandomUserAgentMiddleware
 
-import random
-import time
+from pd_crawl import (
+    DEFAULT_STATE_PATH, DOWNLOAD_PRIORITY, CrawlState, LinkFrontier, PatchStore, domain_key, is_archive_url, is_patch_url,
+)
+from pd_metrics import increment, metrics, observe, timed
+
+DEFAULT_METRICS_PATH = os.path.join("crawls", "pd_metrics.json")
 
 class RandomUserAgentMiddleware(UserAgentMiddleware):
     def __init__(self, user_agent=''):
@@ -33,20 +37,6 @@ class RandomUserAgentMiddleware(UserAgentMiddleware):
     ]
 
 
-class RandomDelayMiddleware(object):
-    def __init__(self, delay):
-        self.delay = delay
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        return cls(crawler.settings.getfloat('DOWNLOAD_DELAY'))
-
-    def process_request(self, request, spider):
-        delay = random.uniform(1.5*self.delay, 2.5*self.delay)
-        time.sleep(delay)
-        spider.logger.debug(f"RandomDelayMiddleware: Sleeping for {delay:.2f} seconds")
-
-
 class PdSpider(scrapy.Spider):
     name = "pd"
     allowed_domains = [
@@ -67,13 +57,21 @@ class PdSpider(scrapy.Spider):
     ]
     custom_settings = {
         "ROBOTSTXT_OBEY": True,
-        "CONCURRENT_REQUESTS": 2,
-        "DOWNLOAD_DELAY": 15,
+        # Politeness is enforced per domain by Scrapy's download slots, which wait
+        # with reactor timers instead of blocking, so the sites crawl in parallel
+        # while each one still sees a single request every 15-45 seconds
+        "CONCURRENT_REQUESTS": 12,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": 1,
+        "DOWNLOAD_DELAY": 30,
+        "RANDOMIZE_DOWNLOAD_DELAY": True,
+        # AutoThrottle adjusts each slot's delay on its own, never below DOWNLOAD_DELAY
         "AUTOTHROTTLE_ENABLED": True,
-        "AUTOTHROTTLE_START_DELAY": 5,
-        "AUTOTHROTTLE_MAX_DELAY": 60,
+        "AUTOTHROTTLE_START_DELAY": 30,
+        "AUTOTHROTTLE_MAX_DELAY": 120,
         "AUTOTHROTTLE_TARGET_CONCURRENCY": 1,
         "COOKIES_ENABLED": True,
+        # Persist the scheduler queue and seen requests so an interrupted crawl resumes where it stopped
+        "JOBDIR": os.path.join("crawls", "pd"),
         "DOWNLOADER_MIDDLEWARES": {
             'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
             'random_useragent.RandomUserAgentMiddleware': 400,
@@ -84,7 +82,6 @@ class PdSpider(scrapy.Spider):
             'scrapy.downloadermiddlewares.cookies.CookiesMiddleware': 800,
             'scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware': 810,
             'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': 900,
-            'random_delay.RandomDelayMiddleware': 999
         },
         "ROTATING_PROXY_LIST_PATH": "/path/to/proxies.txt",
         "HTTPCACHE_ENABLED": True,
@@ -94,18 +91,39 @@ class PdSpider(scrapy.Spider):
         "HTTPCACHE_STORAGE": 'scrapy.extensions.httpcache.FilesystemCacheStorage',
     }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, state_path=DEFAULT_STATE_PATH, metrics_path=DEFAULT_METRICS_PATH, **kwargs):
         super().__init__(*args, **kwargs)
+        self.metrics_path = metrics_path
         self.save_directory = "/Users/macuser/Documents/GitHub/PureDataGPT/TrainingData"
+        self.crawl_state = CrawlState(state_path)
+        self.frontier = LinkFrontier(self.crawl_state)
+        self.patch_store = PatchStore(self.save_directory, self.crawl_state)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
+        return spider
+
+    def spider_closed(self, spider, reason):
+        self.crawl_state.close()
+        metrics.export(self.metrics_path)
+        for line in metrics.summary_lines():
+            self.logger.info(line)
+        jobdir = self.settings.get("JOBDIR")
+        # A finished crawl forgets the requests it has seen, so the next run walks
+        # the sites again and re-checks downloads with conditional requests.
+        # Interrupted crawls keep the job directory to resume from
+        if reason == "finished" and jobdir:
+            seen_path = os.path.join(jobdir, "requests.seen")
+            if os.path.exists(seen_path):
+                os.remove(seen_path)
+            shutil.rmtree(os.path.join(jobdir, "requests.queue"), ignore_errors=True)
 
     # Define a function to generate a random wait time between 2 and 6 seconds
     def get_wait_time(self):
         return random.uniform(2, 6)
 
-    # Define a function to generate a unique filename based on the URL
-    def get_filename(self, url):
-        return hashlib.sha256(url.encode()).hexdigest() + ".pd"
-
     def start_requests(self):
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36',
@@ -115,41 +133,101 @@ class PdSpider(scrapy.Spider):
                 yield scrapy.Request(url, headers=headers, callback=self.parse)
 
 
-    # Define the entry point to start parsing links
+    # Define the entry point to start parsing links. Patch links are downloaded
+    # first; other links are queued by the frontier's score, or dropped
+    @timed("spider.parse")
     def parse(self, response):
-        for link in response.css("a::attr(href)").getall():
-            if link.endswith(".pd") or link.endswith(".zip"):
-                download_url = response.urljoin(link)
-                yield scrapy.Request(download_url, callback=self.download_file)
-            else:
-                yield response.follow(link, callback=self.parse_links)
-
-    # Define a function to download a file
-    def download_file(self, response):
-        # Set the download path
-        download_path = os.path.join(self.save_directory, self.get_filename(response.url))
-
-        # Download the file
-        request = scrapy.Request(response.url, callback=self.save_file)
-        request.meta["download_path"] = download_path
-        yield request
-
-    # Define a function to save the file
+        self.record_download(response)
+        depth = response.meta.get("depth", 0)
+        patch_links = 0
+        for anchor in response.css("a[href]"):
+            url = response.urljoin(anchor.attrib["href"])
+            if is_patch_url(url):
+                patch_links += 1
+                yield self.download_request(url)
+                continue
+            if not url.startswith(("http://", "https://")):
+                continue
+            anchor_text = " ".join(anchor.css("::text").getall())
+            priority = self.frontier.score(url, anchor_text, depth + 1)
+            if priority is not None:
+                yield scrapy.Request(url, callback=self.parse, priority=priority)
+        self.frontier.page_done(response.url, patch_links)
+        increment("crawl.pages")
+        increment("crawl.patch_links", patch_links)
+        domain = domain_key(response.url)
+        if self.frontier.exhausted(domain):
+            self.logger.info(f"Crawl budget for {domain} exhausted after {self.frontier.pages[domain]} pages")
+
+    # Request a file once, conditionally when it was downloaded before. Downloads
+    # bypass the HTTP cache because CrawlState already tracks their freshness
+    def download_request(self, url):
+        return scrapy.Request(
+            url,
+            callback=self.save_file,
+            priority=DOWNLOAD_PRIORITY,
+            headers=self.crawl_state.conditional_headers(url),
+            meta={
+                "handle_httpstatus_list": [304],
+                "dont_cache": True,
+            },
+        )
+
+    # Time from sending a request to receiving its response. The politeness
+    # delay is spent before the request is sent, so it is not included
+    def record_download(self, response):
+        latency = response.meta.get("download_latency")
+        if latency is not None:
+            observe("crawl.download_latency", latency)
+        increment(f"crawl.status.{response.status}")
+
+    def response_validators(self, response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        return (etag.decode("latin-1") if etag else None,
+                last_modified.decode("latin-1") if last_modified else None)
+
+    # Define a function to save the file. Archives are read from the response
+    # body in memory and only their .pd members are written, each under the hash
+    # of its own content
+    @timed("spider.save_file")
     def save_file(self, response):
-        download_path = response.meta["download_path"]
-        if response.status == 200:
-            with open(download_path, "wb") as f:
-                f.write(response.body)
-            # Check for zip file and extract pd files
-            if download_path.endswith(".zip"):
-                with zipfile.ZipFile(download_path, "r") as zip_ref:
-                    for filename in zip_ref.namelist():
-                        if filename.endswith(".pd"):
-                            zip_ref.extract(filename, os.path.dirname(download_path))
-                            self.logger.info(f"Downloaded: {filename}")
-            else:
-                self.logger.info(f"Downloaded: {download_path}")
-        else:
+        self.record_download(response)
+        etag, last_modified = self.response_validators(response)
+        if response.status == 304:
+            self.crawl_state.mark_unchanged(response.url, etag, last_modified)
+            self.logger.debug(f"Not modified: {response.url}")
+            return
+        if response.status != 200:
             self.logger.warning(f"Failed to download: {response.url}")
-
-
+            return
+
+        sha256 = hashlib.sha256(response.body).hexdigest()
+        previous = self.crawl_state.get(response.url)
+        if (previous is not None and previous["sha256"] == sha256
+                and (previous["path"] is None or os.path.exists(previous["path"]))):
+            self.crawl_state.mark_unchanged(response.url, etag, last_modified)
+            self.logger.debug(f"Unchanged: {response.url}")
+            increment("crawl.unchanged")
+            return
+
+        path = None
+        if is_archive_url(response.url):
+            skipped = []
+            try:
+                paths = self.patch_store.store_archive(response.body, response.url, skipped)
+            except zipfile.BadZipFile as error:
+                self.logger.warning(f"Unreadable archive {response.url}: {error}")
+                return
+            for reason in skipped:
+                self.logger.warning(f"Skipped in {response.url}: {reason}")
+            self.logger.info(f"Downloaded {len(paths)} patch(es) from {response.url}")
+            increment("crawl.patches", len(paths))
+        else:
+            path = self.patch_store.store(response.body, response.url)
+            if path is None:
+                self.logger.warning(f"Not a Pd patch: {response.url}")
+            else:
+                self.logger.info(f"Downloaded: {path}")
+                increment("crawl.patches")
+        self.crawl_state.record(response.url, etag, last_modified, sha256, len(response.body), path)
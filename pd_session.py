@@ -0,0 +1,191 @@
+import os
+import re
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+
+from pd_metrics import span, timed
+
+CONNECT_TIMEOUT = 10
+FUDI_ESCAPE_RE = re.compile(r"[\\;,$ ]")
+
+# Control patch loaded into the session's Pd. Every FUDI message arriving on
+# the [netreceive] port is one of:
+#   open <name> <dir>;        opens a patch (pd open)
+#   close symbol <name>;      closes it, without asking to save (pd-<name> menuclose 1)
+#   dsp <0|1>;                switches audio processing
+#   quit;                     exits Pd
+CONTROL_PATCH = """#N canvas 0 50 450 300 12;
+#X obj 20 20 netreceive {port};
+#X obj 20 50 route open close dsp quit;
+#X obj 20 80 list prepend open;
+#X obj 20 140 list trim;
+#X obj 20 170 s pd;
+#X obj 160 80 makefilename pd-%s;
+#X obj 160 110 t b s;
+#X msg 160 140 menuclose 1;
+#X obj 160 170 send;
+#X obj 300 80 list prepend dsp;
+#X msg 400 80 quit;
+#X connect 0 0 1 0;
+#X connect 1 0 2 0;
+#X connect 2 0 3 0;
+#X connect 3 0 4 0;
+#X connect 1 1 5 0;
+#X connect 5 0 6 0;
+#X connect 6 1 8 1;
+#X connect 6 0 7 0;
+#X connect 7 0 8 0;
+#X connect 1 2 9 0;
+#X connect 9 0 3 0;
+#X connect 1 3 10 0;
+#X connect 10 0 4 0;
+"""
+
+def fudi_message(*atoms):
+    return " ".join(FUDI_ESCAPE_RE.sub(r"\\\g<0>", str(atom)) for atom in atoms) + ";\n"
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+# One long-lived Pd that generated patches are opened in, replacing the
+# previous patch, instead of starting a new Pd and audio device per patch.
+# Commands go over a FUDI connection to the control patch above. With
+# pd_path=None the session attaches to a Pd that is already listening on port.
+# A session that failed to start stays failed, so callers fall back to opening
+# patches in a new Pd straight away instead of waiting out connect_timeout again
+class PdSession:
+    def __init__(self, pd_path, port=None, gui=True, extra_args=(), connect_timeout=CONNECT_TIMEOUT):
+        self.pd_path = pd_path
+        self.port = port or free_port()
+        self.gui = gui
+        self.extra_args = list(extra_args)
+        self.connect_timeout = connect_timeout
+        self.process = None
+        self.control_dir = None
+        self.connection = None
+        self.current_patch = None
+        self.failed = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    @property
+    def running(self):
+        return self.connection is not None and (self.process is None or self.process.poll() is None)
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            if self.failed is not None:
+                raise ConnectionError(f"Pd session failed to start earlier: {self.failed}")
+            self.disconnect()
+            self.stop_process()
+            try:
+                # Time until the new Pd accepts commands, so a cold launch shows up apart from patch switches
+                with span("pd_session.start"):
+                    if self.pd_path is not None:
+                        self.control_dir = tempfile.mkdtemp(prefix="pd-session-")
+                        control_path = os.path.join(self.control_dir, "session-control.pd")
+                        with open(control_path, "w") as file:
+                            file.write(CONTROL_PATCH.format(port=self.port))
+                        args = [self.pd_path, *([] if self.gui else ["-nogui"]), *self.extra_args, "-open", control_path]
+                        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL)
+                    self.connection = self.connect()
+            except OSError as error:
+                self.failed = str(error)
+                self.stop_process()
+                raise
+            self.current_patch = None
+
+    # Pd needs a moment to load the control patch, so retry until it listens
+    def connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return socket.create_connection(("127.0.0.1", self.port), timeout=self.connect_timeout)
+            except OSError:
+                if self.process is not None and self.process.poll() is not None:
+                    raise ConnectionError(f"Pd exited with status {self.process.returncode} before accepting commands")
+                if time.monotonic() > deadline:
+                    raise ConnectionError(f"Pd did not accept commands on port {self.port}")
+                time.sleep(0.05)
+
+    def send(self, *atoms):
+        self.connection.sendall(fudi_message(*atoms).encode("utf-8"))
+
+    # Open a patch, closing the one opened before it. Pd keys open patches by
+    # file name, so a patch rewritten in place is closed and opened again
+    @timed("pd_session.open_patch")
+    def open_patch(self, path):
+        self.start()
+        path = os.path.abspath(path)
+        with self.lock:
+            if self.current_patch is not None:
+                self.send("close", "symbol", os.path.basename(self.current_patch))
+            self.send("open", os.path.basename(path), os.path.dirname(path))
+            self.current_patch = path
+
+    def close_patch(self):
+        with self.lock:
+            if self.current_patch is not None and self.running:
+                self.send("close", "symbol", os.path.basename(self.current_patch))
+            self.current_patch = None
+
+    def dsp(self, on=True):
+        self.start()
+        with self.lock:
+            self.send("dsp", 1 if on else 0)
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None and self.process is not None:
+                try:
+                    self.send("quit")
+                except OSError:
+                    pass
+            self.disconnect()
+            self.stop_process(timeout=2)
+            self.current_patch = None
+
+    # Wait for Pd to exit (after quit), terminating it if it does not, and
+    # remove the directory holding its control patch
+    def stop_process(self, timeout=0):
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.process.terminate()
+                self.process.wait()
+            self.process = None
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+pd_session = None
+
+# A new Pd path (say, after the user installs Pd) gets a fresh session, which
+# also clears an earlier failure to start
+def get_pd_session(pd_path):
+    global pd_session
+    if pd_session is None or pd_session.pd_path != pd_path:
+        if pd_session is not None:
+            pd_session.close()
+        pd_session = PdSession(pd_path)
+    return pd_session
@@ -0,0 +1,71 @@
+import os
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+
+# Entry points timed by default: the GUI and the headless batch, render and
+# dataset tools. Modules whose dependencies are not installed are skipped
+DEFAULT_MODULES = ["pureDataGPT", "pd_batch", "pd_render", "pd_retrieval", "processTrainingData"]
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+# Import module in a fresh interpreter under -X importtime. Returns its total
+# in microseconds and the cumulative time of each of its direct imports, or
+# None when the import fails
+def import_profile(module):
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    if completed.returncode != 0:
+        return None
+    # importtime reports children before their parent, so the direct imports
+    # of a top-level module are the depth-2 lines just above it
+    children = {}
+    for line in completed.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        depth = (len(match.group(3)) + 1) // 2
+        if depth == 2:
+            children[match.group(4)] = int(match.group(2))
+        elif depth == 1:
+            if match.group(4) == module:
+                return int(match.group(2)), children
+            children = {}
+    return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold import time of the entry-point modules")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports to list per module")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Exit non-zero when a module's median exceeds this")
+    args = parser.parse_args(argv)
+
+    over_budget = []
+    for module in args.modules:
+        profiles = [import_profile(module) for _ in range(args.runs)]
+        if any(profile is None for profile in profiles):
+            print(f"{module}: skipped (import failed)")
+            continue
+        median_ms = statistics.median(total for total, _ in profiles) / 1000
+        print(f"{module}: {median_ms:.1f} ms median over {args.runs} runs")
+        slowest = sorted(
+            ((name, statistics.median(children.get(name, 0) for _, children in profiles) / 1000)
+             for name in profiles[0][1]),
+            key=lambda item: item[1], reverse=True,
+        )
+        for name, ms in slowest[:args.top]:
+            print(f"    {ms:8.1f} ms  {name}")
+        if args.budget_ms is not None and median_ms > args.budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"Over the {args.budget_ms:.0f} ms budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
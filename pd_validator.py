@@ -0,0 +1,264 @@
+import re
+
+from pd_metrics import timed
+from pd_parser import PdObject, PdRecord, parse, serialize
+
+DEFAULT_CANVAS_HEADER = "#N canvas 0 50 450 300 12;\n"
+
+FENCE_RE = re.compile(r"^\s*```.*$", re.M)
+
+def fixed(inlets, outlets):
+    return lambda args: (inlets, outlets)
+
+def arg_count(args, default):
+    return len(args) if args else default
+
+def int_or(value, default):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+def list_ports(args):
+    return {
+        "append": (2, 1), "prepend": (2, 1), "split": (2, 3), "trim": (1, 1), "length": (1, 1),
+        "fromsymbol": (1, 1), "tosymbol": (1, 1), "store": (2, 2),
+    }.get(args[0] if args else "append", (2, 1))
+
+def select_ports(args):
+    if len(args) <= 1:
+        return 2, 2
+    return 1, len(args) + 1
+
+def route_ports(args):
+    return (2 if len(args) <= 1 else 1), arg_count(args, 1) + 1
+
+def pipe_ports(args):
+    values = max(1, len(args) - 1)
+    return values + 1, values
+
+# Upper bounds on (inlets, outlets) for vanilla objects, computed from the
+# creation arguments. Some objects gained inlets across Pd versions, so the
+# larger count is used; anything not listed (externals, abstractions) is not
+# checked
+BINARY = fixed(2, 1)
+UNARY = fixed(1, 1)
+OBJECT_PORTS = {
+    "bang": UNARY, "b": UNARY, "float": BINARY, "f": BINARY, "int": BINARY, "i": BINARY,
+    "symbol": BINARY, "list": list_ports, "value": BINARY, "v": BINARY,
+    "send": lambda args: (1 if args else 2, 0), "s": lambda args: (1 if args else 2, 0),
+    "receive": lambda args: (0 if args else 1, 1), "r": lambda args: (0 if args else 1, 1),
+    "send~": fixed(1, 0), "s~": fixed(1, 0), "receive~": UNARY, "r~": UNARY,
+    "throw~": fixed(1, 0), "catch~": UNARY,
+    "loadbang": UNARY, "print": fixed(1, 0), "metro": BINARY, "delay": BINARY, "del": BINARY,
+    "timer": BINARY, "pipe": pipe_ports, "until": BINARY, "spigot": BINARY, "moses": fixed(2, 2),
+    "change": UNARY, "random": BINARY, "line": fixed(3, 1), "swap": fixed(2, 2), "clip": fixed(3, 1),
+    "makenote": fixed(3, 2), "stripnote": fixed(2, 2), "noteout": fixed(3, 0), "ctlout": fixed(3, 0),
+    "select": select_ports, "sel": select_ports, "route": route_ports,
+    "trigger": lambda args: (1, arg_count(args, 2)), "t": lambda args: (1, arg_count(args, 2)),
+    "pack": lambda args: (arg_count(args, 2), 1), "unpack": lambda args: (1, arg_count(args, 2)),
+    "+": BINARY, "-": BINARY, "*": BINARY, "/": BINARY, "max": BINARY, "min": BINARY, "pow": BINARY,
+    "mod": BINARY, "div": BINARY, "%": BINARY, "==": BINARY, "!=": BINARY, ">": BINARY, "<": BINARY,
+    ">=": BINARY, "<=": BINARY, "&&": BINARY, "||": BINARY, "&": BINARY, "|": BINARY, "<<": BINARY,
+    ">>": BINARY, "atan2": BINARY, "log": BINARY,
+    "mtof": UNARY, "ftom": UNARY, "dbtopow": UNARY, "powtodb": UNARY, "rmstodb": UNARY, "dbtorms": UNARY,
+    "abs": UNARY, "sqrt": UNARY, "exp": UNARY, "sin": UNARY, "cos": UNARY, "tan": UNARY, "atan": UNARY,
+    "wrap": UNARY,
+    "tabread": BINARY, "tabwrite": fixed(2, 0), "tabread~": fixed(2, 1), "tabread4~": fixed(2, 1),
+    "tabwrite~": fixed(1, 0), "tabplay~": fixed(1, 2), "tabosc4~": BINARY, "tabreceive~": UNARY,
+    "tabsend~": fixed(1, 0), "soundfiler": fixed(1, 2),
+    "readsf~": lambda args: (1, (int_or(args[0], 1) if args else 1) + 1),
+    "writesf~": lambda args: (int_or(args[0], 1) if args else 1, 0),
+    "osc~": BINARY, "phasor~": BINARY, "cos~": UNARY, "noise~": UNARY, "sig~": UNARY,
+    "snapshot~": UNARY, "env~": UNARY, "lop~": BINARY, "hip~": BINARY, "bp~": fixed(3, 1),
+    "vcf~": fixed(3, 2), "rzero~": BINARY, "rpole~": BINARY, "rzero_rev~": BINARY, "czero~": fixed(4, 2),
+    "cpole~": fixed(4, 2), "czero_rev~": fixed(4, 2), "samphold~": BINARY, "delwrite~": fixed(1, 0),
+    "delread~": BINARY, "delread4~": UNARY, "vd~": UNARY, "clip~": fixed(3, 1), "wrap~": UNARY,
+    "abs~": UNARY, "+~": BINARY, "-~": BINARY, "*~": BINARY, "/~": BINARY, "max~": BINARY, "min~": BINARY,
+    "pow~": BINARY, "log~": BINARY, "mtof~": UNARY, "ftom~": UNARY, "sqrt~": UNARY, "rsqrt~": UNARY,
+    "exp~": UNARY, "line~": BINARY, "vline~": fixed(3, 1), "threshold~": fixed(3, 2), "bang~": UNARY,
+    "fft~": fixed(2, 2), "ifft~": fixed(2, 2), "rfft~": fixed(1, 2), "rifft~": fixed(2, 1),
+    "dac~": lambda args: (arg_count(args, 2), 0), "adc~": lambda args: (1, arg_count(args, 2)),
+    "inlet": fixed(0, 1), "inlet~": fixed(0, 2), "outlet": fixed(1, 0), "outlet~": fixed(1, 0),
+    "block~": fixed(1, 0), "switch~": fixed(1, 0),
+    "bng": UNARY, "tgl": UNARY, "nbx": UNARY, "hsl": UNARY, "vsl": UNARY, "hslider": UNARY,
+    "vslider": UNARY, "hradio": UNARY, "vradio": UNARY, "hdl": UNARY, "vdl": UNARY, "vu": fixed(2, 2),
+    "cnv": fixed(1, 0),
+}
+
+# Boxes other than object boxes, by record kind. The [text] object class
+# (#X obj ... text define) shares its name with comments, so comments are
+# looked up by kind; the object class is not checked
+BOX_PORTS = {"msg": UNARY, "floatatom": UNARY, "symbolatom": UNARY, "listbox": UNARY, "text": fixed(0, 0)}
+
+# A subpatch has as many inlets and outlets as the inlet/outlet objects inside it
+def subpatch_ports(obj):
+    names = [child.name for child in obj.subpatch.objects]
+    inlets = sum(name in ("inlet", "inlet~") for name in names)
+    outlets = sum(name in ("outlet", "outlet~") for name in names)
+    return inlets, outlets
+
+def object_ports(obj):
+    if obj.subpatch is not None:
+        return subpatch_ports(obj) if obj.name == "pd" else None
+    ports = BOX_PORTS.get(obj.kind) if obj.kind != "obj" else OBJECT_PORTS.get(obj.name)
+    return ports(obj.args) if ports is not None else None
+
+class ValidationResult:
+    __slots__ = ("text", "patch", "errors", "warnings", "repairs")
+
+    def __init__(self, text, patch):
+        self.text = text
+        self.patch = patch
+        self.errors = []
+        self.warnings = []
+        self.repairs = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+# Check a patch's structure without starting Pd: record syntax, the canvas
+# header, connect indices and inlet/outlet numbers for known objects
+def validate_patch(text, patch=None):
+    if patch is None:
+        patch = parse(text)
+    result = ValidationResult(text, patch)
+    result.errors.extend(patch.errors)
+    if patch.prelude and any(not record.chunk.startswith("#") for record in patch.prelude):
+        result.errors.append("Text before the #N canvas header")
+
+    if patch.root is not None and not patch.root.objects:
+        result.errors.append("Patch contains no objects")
+
+    records = list(patch.iter_records())
+    if records and not records[-1].terminated:
+        result.errors.append("Last record is not terminated with ';'")
+
+    for canvas in patch.iter_canvases():
+        objects = canvas.objects
+        seen = set()
+        for connection in canvas.iter_connections():
+            result.errors.extend(connection_errors(objects, *connection))
+            if connection in seen:
+                result.warnings.append(f"Duplicate connection {' '.join(map(str, connection))}")
+            seen.add(connection)
+    return result
+
+def connection_errors(objects, source, outlet, sink, inlet):
+    label = f"connect {source} {outlet} {sink} {inlet}"
+    if not 0 <= source < len(objects) or not 0 <= sink < len(objects):
+        return [f"{label}: object index out of range (canvas has {len(objects)} objects)"]
+    errors = []
+    source_ports = object_ports(objects[source])
+    if source_ports is not None and not 0 <= outlet < source_ports[1]:
+        errors.append(f"{label}: {objects[source].name} has {source_ports[1]} outlet(s)")
+    sink_ports = object_ports(objects[sink])
+    if sink_ports is not None and not 0 <= inlet < sink_ports[0]:
+        errors.append(f"{label}: {objects[sink].name} has {sink_ports[0]} inlet(s)")
+    return errors
+
+def strip_to_patch(text):
+    text = FENCE_RE.sub("", text)
+    start = text.find("#N canvas")
+    if start == -1:
+        match = re.search(r"^#[NXA] ", text, re.M)
+        start = match.start() if match else 0
+    return text[start:].strip() + "\n"
+
+# Repair the common ways model output breaks a patch: markdown fences and prose
+# around the code, a missing canvas header or final ';', unclosed subpatches
+# and connections that point at objects or ports that do not exist
+def repair_patch(text):
+    repairs = []
+    stripped = strip_to_patch(text)
+    if stripped.strip() != text.strip():
+        repairs.append("Removed text around the patch")
+    if "#N canvas" not in stripped:
+        stripped = DEFAULT_CANVAS_HEADER + stripped
+        repairs.append("Added a #N canvas header")
+
+    patch = parse(stripped)
+    patch.prelude = [record for record in patch.prelude if record.chunk.startswith("#")]
+    canvases = list(patch.iter_canvases())
+    for canvas in canvases:
+        for item in canvas.body:
+            if isinstance(item, PdObject) and item.record is None:
+                item.record = PdRecord(("#X", "restore", "0", "0", "pd", "subpatch"))
+                canvas.objects.append(item)
+                repairs.append("Closed a subpatch missing its #X restore")
+
+    for canvas in canvases:
+        body = []
+        for item in canvas.body:
+            if isinstance(item, PdObject):
+                if not item.record.terminated:
+                    item.record = PdRecord(item.record.atoms)
+                    repairs.append("Terminated the last record with ';'")
+            elif not item.chunk.startswith("#"):
+                repairs.append(f"Removed stray text: {' '.join(item.atoms)[:40]}")
+                continue
+            elif item.chunk == "#X" and item.selector == "connect" and not connection_is_valid(canvas.objects, item):
+                repairs.append(f"Removed connection: {' '.join(item.atoms[2:])}")
+                continue
+            elif not item.terminated:
+                item = PdRecord(item.atoms)
+                repairs.append("Terminated the last record with ';'")
+            body.append(item)
+        canvas.body = body
+    return serialize(patch), repairs
+
+def connection_is_valid(objects, record):
+    try:
+        source, outlet, sink, inlet = (int(atom) for atom in record.atoms[2:6])
+    except ValueError:
+        return False
+    return not connection_errors(objects, source, outlet, sink, inlet)
+
+# Validate a generated patch, repairing it first when it does not pass as-is
+def prepare_patch(text, repair=True):
+    result = validate_patch(text)
+    if result.ok or not repair:
+        return result
+    repaired_text, repairs = repair_patch(text)
+    repaired = validate_patch(repaired_text)
+    repaired.repairs = repairs
+    return repaired
+
+# Score a candidate for best-of-n selection. Patches that fail validation rank
+# below every patch that passes; after that, fewer repairs and warnings, sound
+# output through dac~, objects that are wired up and more content (up to a
+# point) rank higher
+def score_candidate(result):
+    objects = [obj for obj in result.patch.iter_objects() if obj.record is not None and obj.name != "text"]
+    score = 0.0
+    if not result.ok:
+        score -= 1000 + 10 * len(result.errors)
+    score -= 5 * len(result.repairs) + 2 * len(result.warnings)
+    if any(obj.name == "dac~" for obj in objects):
+        score += 20
+    wired = set()
+    for canvas in result.patch.iter_canvases():
+        for source, _, sink, _ in canvas.iter_connections():
+            wired.add((id(canvas), source))
+            wired.add((id(canvas), sink))
+    if objects:
+        score += 20 * min(len(wired) / len(objects), 1.0)
+    score += min(len(objects), 40) / 2
+    if len(objects) < 3:
+        score -= 10
+    return score
+
+def evaluate_candidate(text, repair=True):
+    result = prepare_patch(text, repair)
+    return score_candidate(result), result
+
+# Validate and score candidate patches, best first, as (score, index, result).
+# Pass an executor to validate them in parallel
+@timed("rank_candidates")
+def rank_candidates(texts, repair=True, executor=None):
+    mapper = executor.map if executor is not None else map
+    evaluated = mapper(evaluate_candidate, texts, [repair] * len(texts))
+    ranked = [(score, index, result) for index, (score, result) in enumerate(evaluated)]
+    ranked.sort(key=lambda item: (-item[0], item[1]))
+    return ranked
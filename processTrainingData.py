@@ -1,80 +1,394 @@
 import os
+import re
+import gzip
 import json
+import sqlite3
+import hashlib
 import subprocess
+import multiprocessing
+from bisect import bisect_right
+from itertools import accumulate
+from pd_dedup import PatchDeduplicator, iter_deduplicated
+from pd_ingest import DEFAULT_CHUNK_SIZE, clean_content, ingest, load_sources, walk_corpus
+from pd_metrics import increment, metrics, profiling, span, timed
+from pd_normalize import normalize_patch
 from tokenizers import Tokenizer
 from tokenizers.models import BPE
 from tokenizers.trainers import BpeTrainer
 from tokenizers.pre_tokenizers import Whitespace
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TOKENIZER_CACHE_DIR = "tokenizer_cache"
+TOKENIZER_VOCAB_SIZE = 50000
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+@timed("create_tokenizer")
 def create_tokenizer(pd_files_data):
     tokenizer = Tokenizer(BPE(unk_token="[UNK]"))
     tokenizer.pre_tokenizer = Whitespace()
-    trainer = BpeTrainer(special_tokens=["[UNK]"], vocab_size=50000)
+    trainer = BpeTrainer(special_tokens=["[UNK]"], vocab_size=TOKENIZER_VOCAB_SIZE)
     tokenizer.train_from_iterator(pd_files_data, trainer)
     return tokenizer
 
-def save_to_jsonl(data, output_file):
-    with open(output_file, 'w', encoding='utf-8') as file:
-        for idx, item in enumerate(data):
-            prompt, completion = item.split("\n\n", 1)
-            json_obj = {"prompt": prompt, "completion": completion}
-            file.write(json.dumps(json_obj, ensure_ascii=False))
-            file.write("\n")
+# Identify a corpus by the paths, sizes and mtimes of its patches so a
+# tokenizer is only retrained when the training files actually change
+def corpus_fingerprint(sources, normalize=False):
+    digest = hashlib.sha256(f"bpe:{TOKENIZER_VOCAB_SIZE}\n{'normalized' if normalize else ''}".encode())
+    for source in sorted(sources, key=lambda source: source.key):
+        digest.update(f"{source.key}\0{source.size}\0{source.mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+@timed("load_or_create_tokenizer")
+def load_or_create_tokenizer(folder_path, max_tokens, cache_dir=TOKENIZER_CACHE_DIR, workers=None, errors=None,
+                             normalize=False):
+    fingerprint = corpus_fingerprint(walk_corpus(folder_path), normalize)
+    tokenizer_path = os.path.join(cache_dir, f"tokenizer-{fingerprint[:16]}.json")
+    if os.path.exists(tokenizer_path):
+        print(f"Loading cached tokenizer: {tokenizer_path}")
+        return Tokenizer.from_file(tokenizer_path)
+
+    tokenizer, _ = prepare_pd_files_data(folder_path, max_tokens, workers, errors, normalize)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary name first so an interrupted run never leaves a partial artifact behind
+    tmp_path = f"{tokenizer_path}.tmp"
+    tokenizer.save(tmp_path)
+    os.replace(tmp_path, tokenizer_path)
+    print(f"Saved tokenizer: {tokenizer_path}")
+    return tokenizer
+
+# Write records to one or more JSONL shards. A new shard is started whenever the
+# next record would push the current one past max_shard_bytes (uncompressed),
+# and a manifest describing every shard is written next to them on close
+class JsonlShardWriter:
+    def __init__(self, output_file, max_shard_bytes=None, compression=None):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unsupported compression: {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        self.output_file = output_file
+        self.max_shard_bytes = max_shard_bytes
+        self.compression = compression
+        self.shards = []
+        self.file = None
+        self.shard_digest = None
+        self.stem = output_file[:-len(".jsonl")] if output_file.endswith(".jsonl") else output_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def shard_path(self, index):
+        if self.max_shard_bytes is None:
+            path = f"{self.stem}.jsonl"
+        else:
+            path = f"{self.stem}-{index:05d}.jsonl"
+        return path + COMPRESSION_SUFFIXES[self.compression]
+
+    def open_shard(self):
+        path = self.shard_path(len(self.shards))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if self.compression == "gzip":
+            self.file = gzip.open(path, "wb")
+        elif self.compression == "zstd":
+            self.file = zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        else:
+            self.file = open(path, "wb")
+        self.shard_digest = hashlib.sha256()
+        self.shards.append({"path": path, "records": 0, "bytes": 0})
+
+    def close_shard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.shards[-1]["sha256"] = self.shard_digest.hexdigest()
+
+    def write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        shard = self.shards[-1] if self.file is not None else None
+        if shard is None or (self.max_shard_bytes is not None and shard["records"]
+                             and shard["bytes"] + len(line) > self.max_shard_bytes):
+            self.close_shard()
+            self.open_shard()
+            shard = self.shards[-1]
+        self.file.write(line)
+        self.shard_digest.update(line)
+        shard["records"] += 1
+        shard["bytes"] += len(line)
+
+    # Remove output an earlier run left behind that this one did not overwrite:
+    # higher-numbered shards, shards in another compression and the unsharded
+    # file, so the directory always holds exactly the shards in the manifest
+    def remove_stale_outputs(self):
+        directory = os.path.dirname(self.stem) or "."
+        if not os.path.isdir(directory):
+            return
+        written = {os.path.normpath(shard["path"]) for shard in self.shards}
+        pattern = re.compile(re.escape(os.path.basename(self.stem)) + r"(-\d{5})?\.jsonl(\.gz|\.zst)?")
+        for name in os.listdir(directory):
+            path = os.path.normpath(os.path.join(directory, name))
+            if pattern.fullmatch(name) and path not in written:
+                os.remove(path)
+
+    def close(self):
+        self.close_shard()
+        self.remove_stale_outputs()
+        self.manifest = {
+            "compression": self.compression,
+            "max_shard_bytes": self.max_shard_bytes,
+            "records": sum(shard["records"] for shard in self.shards),
+            "bytes": sum(shard["bytes"] for shard in self.shards),
+            "shards": self.shards,
+        }
+        with open(f"{self.stem}.manifest.json", "w", encoding="utf-8") as file:
+            json.dump(self.manifest, file, indent=2)
+
+@timed("save_to_jsonl")
+def save_to_jsonl(records, output_file, max_shard_bytes=None, compression=None):
+    with JsonlShardWriter(output_file, max_shard_bytes, compression) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.manifest
 
 def read_pd_file(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         content = file.read()
     return content
 
-def clean_content(content):
-    content = content.replace("\t", " ").replace("\r", "").strip()
-    lines = content.split("\n")
-    cleaned_lines = [line.strip() for line in lines]
-    cleaned_content = "\n".join(cleaned_lines)
-    return cleaned_content
-
-def process_pd_files(folder_path, tokenizer, max_tokens):
-    data = []
-    for file in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, file)
-        if os.path.isdir(file_path):
-            data.extend(process_pd_files(file_path, tokenizer, max_tokens))
-        elif file.endswith(".pd"):
-            content = read_pd_file(file_path)
-            cleaned_content = clean_content(content)
-            title_and_content = f"PureData Patch: {file[:-3]}\n\n {cleaned_content}\n"
-
-            lines = title_and_content.split("\n")
-            truncated_lines = []
-            tokens_so_far = 0
-
-            if tokenizer is None:
-                tokenizer = create_tokenizer(process_pd_files(folder_path, tokenizer=None, max_tokens=max_tokens))
-
-            for line in lines:
-                line_tokens = tokenizer.encode(line).tokens
-                if tokens_so_far + len(line_tokens) < max_tokens:
-                    truncated_lines.append(line)
-                    tokens_so_far += len(line_tokens)
-                else:
-                    truncated_lines = []
-                    break
-
-            truncated_text = "\n".join(truncated_lines)
-
-            if truncated_text:
-                data.append(truncated_text)
-    return data
-
-def prepare_pd_files_data(folder_path, max_tokens):
+# Apply the max_tokens budget to a batch of patches. encode_batch tokenizes the
+# whole batch in parallel across all cores; a patch that does not fit is dropped
+# (None) unless truncate is set, in which case it is cut at the last whole line
+# that fits, using the token offsets to find the line with a binary search
+@timed("apply_token_budget")
+def apply_token_budget(texts, tokenizer, max_tokens, truncate=False):
+    results = []
+    for text, encoding in zip(texts, tokenizer.encode_batch(texts)):
+        if len(encoding.ids) < max_tokens:
+            results.append(text)
+        elif truncate and max_tokens > 0:
+            cut_offset = encoding.offsets[max_tokens - 1][0]
+            line_starts = [0, *accumulate(len(line) + 1 for line in text.split("\n"))]
+            line_index = bisect_right(line_starts, cut_offset) - 1
+            results.append(text[:max(line_starts[line_index] - 1, 0)] or None)
+        else:
+            results.append(None)
+    return results
+
+# With normalize, the patch is first rewritten in canonical form (see
+# pd_normalize), which spends fewer tokens on layout and GUI defaults
+def format_patch(file_path, content, normalize=False):
+    if normalize:
+        content = normalize_patch(content)
+    file = os.path.basename(file_path)
+    return f"PureData Patch: {file[:-3]}", f" {clean_content(content)}\n"
+
+# Turn a batch of (prompt, completion) pairs into records, with None for
+# patches where nothing past the title survived the budget
+def budget_records(patches, tokenizer, max_tokens, truncate=False):
+    texts = [f"{prompt}\n\n{completion}" for prompt, completion in patches]
+    records = []
+    for (prompt, _), truncated_text in zip(patches, apply_token_budget(texts, tokenizer, max_tokens, truncate)):
+        if truncated_text and len(truncated_text) > len(prompt) + 2:
+            records.append({"prompt": prompt, "completion": truncated_text[len(prompt) + 2:]})
+        else:
+            records.append(None)
+    return records
+
+# Per-process state of an ingestion worker, set once by init_ingest_worker
+ingest_state = {}
+
+def init_ingest_worker(tokenizer_json=None, max_tokens=None, truncate=False, normalize=False):
+    if multiprocessing.parent_process() is not None:
+        # Every worker already has a core to itself, so keep encode_batch on one thread
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    ingest_state["tokenizer"] = Tokenizer.from_str(tokenizer_json) if tokenizer_json is not None else None
+    ingest_state["max_tokens"] = max_tokens
+    ingest_state["truncate"] = truncate
+    ingest_state["normalize"] = normalize
+
+# Read, decode, clean and budget one chunk of sources. Each result carries the
+# source's stat signature and content hash, plus its record (None when dropped
+# by the budget), or just the training text when the worker has no tokenizer.
+# A source that cannot be read or formatted is returned with its error instead
+def process_ingest_chunk(sources):
+    results = []
+    patches = []
+    for source, content, encoding, error in load_sources(sources):
+        result = {"key": source.key, "size": source.size, "mtime_ns": source.mtime_ns, "error": error}
+        if error is None:
+            try:
+                patch = format_patch(source.name, content, ingest_state["normalize"])
+            except Exception as format_error:
+                result["error"] = f"{type(format_error).__name__}: {format_error}"
+            else:
+                result["sha256"] = hashlib.sha256(content.encode("utf-8")).hexdigest()
+                result["encoding"] = encoding
+                patches.append((result, patch))
+        results.append(result)
+
+    tokenizer = ingest_state["tokenizer"]
+    if tokenizer is None:
+        for result, (prompt, completion) in patches:
+            result["text"] = f"{prompt}\n\n{completion}"
+    elif patches:
+        records = budget_records([patch for _, patch in patches], tokenizer, ingest_state["max_tokens"], ingest_state["truncate"])
+        for (result, _), record in zip(patches, records):
+            result["record"] = record
+    return results
+
+# Fan process_ingest_chunk out over worker processes. Workers are spawned
+# rather than forked: the tokenizer's thread pool does not survive a fork
+def ingest_sources(sources, tokenizer=None, max_tokens=None, truncate=False, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                   normalize=False):
+    tokenizer_json = tokenizer.to_str() if tokenizer is not None else None
+    return ingest(sources, process_ingest_chunk, workers, chunk_size, init_ingest_worker,
+                  (tokenizer_json, max_tokens, truncate, normalize), multiprocessing.get_context("spawn"))
+
+# Stream {"prompt": ..., "completion": ...} records from the folder in corpus
+# order, holding only the chunks in flight in memory. Files that cannot be read
+# are appended to errors instead of stopping the build. With with_source each
+# record comes as a (source key, record) pair, since titles are not unique
+def iter_pd_records(folder_path, tokenizer, max_tokens, truncate=False, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+                    errors=None, normalize=False, with_source=False):
+    if tokenizer is None:
+        tokenizer = load_or_create_tokenizer(folder_path, max_tokens, workers=workers, errors=errors, normalize=normalize)
+
+    for result in ingest_sources(walk_corpus(folder_path, errors), tokenizer, max_tokens, truncate, workers, chunk_size,
+                                 normalize):
+        if result["error"] is not None:
+            increment("dataset.failed")
+            if errors is not None:
+                errors.append({"path": result["key"], "error": result["error"]})
+        elif result["record"] is not None:
+            increment("dataset.records")
+            yield (result["key"], result["record"]) if with_source else result["record"]
+        else:
+            increment("dataset.over_budget")
+
+# On-disk index for incremental rebuilds. Each patch is stored with its stat
+# signature, content hash and processed record (NULL when it was dropped by the
+# budget), so a rebuild only reads and tokenizes files that changed. The build
+# key covers the settings that affect a record; when it changes the index is
+# reset. The tokenizer the records were budgeted with is stored alongside them
+# rather than in the key, so that adding patches (which changes the corpus
+# fingerprint) does not retrain the tokenizer and throw the index away
+class DatasetIndex:
+    def __init__(self, index_path, build_key):
+        self.connection = sqlite3.connect(index_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS patches (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT,
+                prompt TEXT,
+                completion TEXT
+            );
+        """)
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'build_key'").fetchone()
+        if row is None or row[0] != build_key:
+            self.connection.execute("DELETE FROM patches")
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('build_key', ?)", (build_key,))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def stored_tokenizer(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'tokenizer'").fetchone()
+        return Tokenizer.from_str(row[0]) if row is not None else None
+
+    # Budget records with tokenizer from now on. Records budgeted with another
+    # tokenizer are stale, so switching to a different one clears them
+    def use_tokenizer(self, tokenizer):
+        tokenizer_json = tokenizer.to_str()
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'tokenizer'").fetchone()
+        if row is None or row[0] != tokenizer_json:
+            self.connection.execute("DELETE FROM patches")
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (tokenizer_json,))
+            self.connection.commit()
+
+    @timed("dataset_index.update")
+    def update(self, folder_path, tokenizer, max_tokens, truncate=False, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+               errors=None, normalize=False):
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "failed": 0}
+        known = {row[0]: row[1:] for row in self.connection.execute("SELECT path, size, mtime_ns, sha256 FROM patches")}
+        seen = set()
+        changed = []
+        for source in walk_corpus(folder_path, errors):
+            seen.add(source.key)
+            previous = known.get(source.key)
+            if previous is not None and previous[:2] == (source.size, source.mtime_ns):
+                stats["unchanged"] += 1
+            else:
+                changed.append(source)
+
+        for result in ingest_sources(changed, tokenizer, max_tokens, truncate, workers, chunk_size, normalize):
+            key = result["key"]
+            previous = known.get(key)
+            if result["error"] is not None:
+                # Keep whatever the last successful run stored for this file
+                if errors is not None:
+                    errors.append({"path": key, "error": result["error"]})
+                stats["failed"] += 1
+            elif previous is not None and previous[2] == result["sha256"]:
+                # Touched but not modified: refresh the stat signature only
+                self.connection.execute(
+                    "UPDATE patches SET size = ?, mtime_ns = ? WHERE path = ?",
+                    (result["size"], result["mtime_ns"], key),
+                )
+                stats["unchanged"] += 1
+            else:
+                record = result["record"]
+                prompt, completion = (record["prompt"], record["completion"]) if record else (None, None)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO patches VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, result["size"], result["mtime_ns"], result["sha256"], prompt, completion),
+                )
+                stats["updated" if previous is not None else "added"] += 1
+
+        removed = [(key,) for key in known if key not in seen]
+        self.connection.executemany("DELETE FROM patches WHERE path = ?", removed)
+        stats["removed"] = len(removed)
+        self.connection.commit()
+        for name, value in stats.items():
+            increment(f"dataset_index.{name}", value)
+        return stats
+
+    def iter_records(self, with_source=False):
+        rows = self.connection.execute(
+            "SELECT path, prompt, completion FROM patches WHERE prompt IS NOT NULL ORDER BY path"
+        )
+        for path, prompt, completion in rows:
+            record = {"prompt": prompt, "completion": completion}
+            yield (path, record) if with_source else record
+
+def dataset_build_key(max_tokens, truncate, normalize=False):
+    return json.dumps({"max_tokens": max_tokens, "truncate": truncate, "normalize": normalize})
+
+@timed("process_pd_files")
+def process_pd_files(folder_path, tokenizer, max_tokens, truncate=False, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+                     normalize=False):
+    records = iter_pd_records(folder_path, tokenizer, max_tokens, truncate, chunk_size, workers, normalize=normalize)
+    return [f"{record['prompt']}\n\n{record['completion']}" for record in records]
+
+# Collect the training texts for the tokenizer from the same sources the
+# dataset is built from, then train on them
+@timed("prepare_pd_files_data")
+def prepare_pd_files_data(folder_path, max_tokens, workers=None, errors=None, normalize=False):
     pd_files_data = []
-    for file in os.listdir(folder_path):
-        if file.endswith(".pd"):
-            file_path = os.path.join(folder_path, file)
-            content = read_pd_file(file_path)
-            cleaned_content = clean_content(content)
-            title_and_content = f"PureData Patch: {file[:-3]}\n\n {cleaned_content}\n"
-            pd_files_data.append(title_and_content)
+    for result in ingest_sources(walk_corpus(folder_path, errors), workers=workers, normalize=normalize):
+        if result["error"] is not None:
+            if errors is not None:
+                errors.append({"path": result["key"], "error": result["error"]})
+        else:
+            pd_files_data.append(result["text"])
 
     tokenizer = create_tokenizer(pd_files_data)
     return tokenizer, pd_files_data
@@ -83,14 +397,86 @@ def main():
     folder_path = "/Users/macuser/Documents/GitHub/PureDataGPT/TrainingData"
     output_file = "pd_files.jsonl"
     max_tokens = 2048
+    # Drop patches over the budget; set to True to keep their leading lines instead
+    truncate = False
+    # Set a byte limit to split the output into numbered shards, and "gzip" or "zstd" to compress them
+    max_shard_bytes = None
+    compression = None
+    # Only reprocess patches that changed since the last run, reusing the rest from the index
+    incremental = True
+    index_path = "pd_files_index.sqlite"
+    # Incremental builds keep the tokenizer the index was built with; set to True to
+    # train one on the current corpus instead, which reprocesses every patch
+    retrain_tokenizer = False
+    # Collapse exact and near-duplicate patches, writing the clusters to a report
+    deduplicate = True
+    dedup_report_file = "pd_files.dedup.json"
+    # Worker processes for reading and tokenizing patches (None uses every core)
+    workers = None
+    # Rewrite patches in canonical form (grid-snapped layout, default GUI parameters
+    # dropped, objects in signal-flow order) so fewer of them run over max_tokens
+    normalize = True
+    # Files that could not be read or decoded are listed here instead of stopping the build
+    errors_file = "pd_files.errors.json"
+    # Stage timings and counters; a .prom path writes Prometheus text instead of JSON
+    metrics_file = "pd_files.metrics.json"
+    # Set to "cprofile" or "py-spy" to profile the build into profile_file
+    profiler = None
+    profile_file = "pd_files.prof" if profiler == "cprofile" else "pd_files.profile.svg"
 
-    tokenizer, pd_files_data = prepare_pd_files_data(folder_path, max_tokens)
-    data = process_pd_files(folder_path, tokenizer, max_tokens)
-    save_to_jsonl(data, output_file)
+    with profiling(profiler, profile_file), span("build_dataset"):
+        manifest = build_dataset(folder_path, output_file, max_tokens, truncate, max_shard_bytes, compression, incremental,
+                                 index_path, deduplicate, dedup_report_file, workers, errors_file, normalize,
+                                 retrain_tokenizer)
+    metrics.export(metrics_file)
+    print(f"Stage timings written to {metrics_file}")
+
+    if compression is not None:
+        print("Skipping fine_tunes.prepare_data, which needs uncompressed JSONL")
+        return
 
     # Call the CLI tool to prepare the data
-    prepare_data_command = f"openai tools fine_tunes.prepare_data -f {output_file}"
-    subprocess.run(prepare_data_command, shell=True, check=True)
+    for shard in manifest["shards"]:
+        prepare_data_command = f"openai tools fine_tunes.prepare_data -f {shard['path']}"
+        subprocess.run(prepare_data_command, shell=True, check=True)
+
+def build_dataset(folder_path, output_file, max_tokens, truncate, max_shard_bytes, compression, incremental, index_path,
+                  deduplicate, dedup_report_file, workers, errors_file, normalize, retrain_tokenizer=False):
+    errors = []
+    if incremental:
+        index = DatasetIndex(index_path, dataset_build_key(max_tokens, truncate, normalize))
+        tokenizer = None if retrain_tokenizer else index.stored_tokenizer()
+        if tokenizer is None:
+            tokenizer = load_or_create_tokenizer(folder_path, max_tokens, workers=workers, errors=errors,
+                                                 normalize=normalize)
+            index.use_tokenizer(tokenizer)
+        stats = index.update(folder_path, tokenizer, max_tokens, truncate, workers=workers, errors=errors,
+                             normalize=normalize)
+        print(f"Index updated: {stats['added']} added, {stats['updated']} updated, "
+              f"{stats['unchanged']} unchanged, {stats['removed']} removed, {stats['failed']} failed")
+        records = index.iter_records(with_source=deduplicate)
+    else:
+        index = None
+        tokenizer = load_or_create_tokenizer(folder_path, max_tokens, workers=workers, errors=errors, normalize=normalize)
+        records = iter_pd_records(folder_path, tokenizer, max_tokens, truncate, workers=workers, errors=errors,
+                                  normalize=normalize, with_source=deduplicate)
+    if deduplicate:
+        deduplicator = PatchDeduplicator()
+        records = iter_deduplicated(records, deduplicator)
+    manifest = save_to_jsonl(records, output_file, max_shard_bytes, compression)
+    if index is not None:
+        index.close()
+    if deduplicate:
+        report = deduplicator.report()
+        with open(dedup_report_file, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+        print(f"Deduplication kept {report['kept']} patches and dropped {report['dropped']}")
+    print(f"Wrote {manifest['records']} records to {len(manifest['shards'])} shard(s)")
+    if errors:
+        with open(errors_file, "w", encoding="utf-8") as file:
+            json.dump(errors, file, indent=2, ensure_ascii=False)
+        print(f"Skipped {len(errors)} unreadable file(s); see {errors_file}")
+    return manifest
 
 if __name__ == "__main__":
     main()
@@ -1,77 +1,107 @@
 import sys
 import os
-import requests
+import shutil
 import subprocess
-import shlex
-import json
 import random
-from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QLineEdit, QPlainTextEdit, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QSlider, QFileDialog, QCheckBox, QStyle, QMessageBox, QDialog
+import threading
+from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QLineEdit, QPlainTextEdit, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QSlider, QFileDialog, QCheckBox, QStyle, QMessageBox, QDialog, QSpinBox
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QFont
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
-from cryptography.fernet import Fernet
-from getpass import getpass
 import base64
 from PyQt5.QtWidgets import QInputDialog
 from PyQt5.QtWidgets import QProgressBar
 from PyQt5.QtCore import QTimer
-from PyQt5.QtCore import QThread
-
+from PyQt5.QtCore import QThread, pyqtSignal
+from pd_validator import rank_candidates
+from pd_completion import CompletionError, build_request_data, get_client
+from pd_cache import get_response_cache
+from pd_retrieval import get_retrieval_index
+from pd_parser import RecordAssembler
+from pd_session import get_pd_session
+from pd_resources import RESOURCE_DIR, random_prompts, witty_messages
+from pd_metrics import metrics, profiling, timed
+
+API_KEY_PATH = os.path.join(RESOURCE_DIR, "api_key.txt")
+# Set to a .json or .prom path to export generation timings when the app exits
+METRICS_PATH = None
+# Set to "cprofile" or "py-spy" to profile the whole session into PROFILE_PATH
+PROFILER = None
+PROFILE_PATH = os.path.join(RESOURCE_DIR, "pureDataGPT.prof" if PROFILER == "cprofile" else "pureDataGPT.profile.svg")
+
+pd_path = None
+
+# Look Pd up on the PATH the first time a patch is opened, not at import
 def get_pd_path():
-    try:
-        result = subprocess.run(shlex.split("which pd"), stdout=subprocess.PIPE)
-        return result.stdout.decode().strip()
-    except:
-        return None
-
-pd_path = get_pd_path()
-if pd_path:
-    print(f"PureData executable found at: {pd_path}")
-else:
-    print("PureData executable not found")
-
-def generate_pd_code(prompt, api_key, temperature):
-    model_engine = "gpt-3.5-turbo"
-    api_endpoint = f"https://api.openai.com/v1/chat/completions"  # Change the endpoint here
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    
-    data = {
-        "model": "gpt-3.5-turbo",
-        "messages": [
-            {"role": "system", "content": "You are a knowledgeable professor of audio technology that can generate complete PureData code."},
-            {"role": "user", "content": f"Represent the following as PureData code: {prompt}"},
-            {"role": "user", "content": f"Follow conventions outlined here:\n\nhttps://puredata.info/docs/manuals/pd/\nhttps://puredata.info/docs/ListOfPdExternals/"},
-            {"role": "user", "content": "Return only .pd code, no other text or information unrelated to the patch"},
-        ],
-        "max_tokens": 1024,
-        "temperature": temperature,
-        "n": 1,
-    }
-
-
-    response = requests.post(api_endpoint, headers=headers, json=data)
-
-    if response.status_code == 200:
-        return response.json()["choices"][0]["message"]["content"], None
-    else:
-        return None, f"Error generating Pure Data code: {response.status_code} - {response.text}"
-
-def generate_start(prompt, api_key, temperature, random_word, save_path=os.path.join(os.path.expanduser("~"), "Documents", "PureDataGPTpatches")):
+    global pd_path
+    if pd_path is None:
+        pd_path = shutil.which("pd")
+        if pd_path:
+            print(f"PureData executable found at: {pd_path}")
+        else:
+            print("PureData executable not found")
+    return pd_path
+
+def show_error(title, message):
+    QMessageBox.warning(None, title, message)
+
+# Failures are reported through on_error(title, message). When this runs on a
+# worker thread, on_error must hand the message to the GUI thread (a signal),
+# since dialogs can only be opened there
+@timed("generate_start")
+def generate_start(prompt, api_key, temperature, random_word, save_path=os.path.join(os.path.expanduser("~"), "Documents", "PureDataGPTpatches"),
+                   on_token=None, on_record=None, cancel_event=None, use_cache=True, candidates=1, on_error=show_error,
+                   cache_sampled=False):
     if api_key == "":
-        QMessageBox.critical(None, "Error", "API key is required")
+        on_error("Error", "API key is required")
         return
     if random_word:
         prompt += f" {get_random_term()}"
-    generated_text, error_message = generate_pd_code(prompt, api_key, temperature)
-    if error_message:
-        QMessageBox.warning(None, "Error", error_message)
-        return
 
-    # Remove any trailing whitespace
-    generated_text = generated_text.rstrip()
+    # Add the most relevant corpus patches as few-shot examples when the index has been built
+    retrieval_index = get_retrieval_index()
+    examples = retrieval_index.examples(prompt) if retrieval_index is not None else ()
+    # With candidates > 1 the model returns that many choices in the same call
+    data = build_request_data(prompt, temperature, n=candidates, examples=examples)
+    # Only deterministic (temperature 0) requests are cached unless cache_sampled
+    # is set, so generating again with the same prompt samples a new patch
+    cache = get_response_cache() if use_cache and (cache_sampled or temperature == 0) else None
+    cached = cache.get(data) if cache is not None else None
+
+    # Stream the completion, reporting each token and each finished #X ...; record as it arrives.
+    # Only the first choice is shown live. A cache hit replays the stored patches through the same path
+    chunks = {}
+    assembler = RecordAssembler()
+    try:
+        stream = list(enumerate(cached)) if cached else get_client(api_key).stream(data, cancel_event)
+        for choice_index, delta in stream:
+            chunks.setdefault(choice_index, []).append(delta)
+            if choice_index != 0:
+                continue
+            if on_token:
+                on_token(delta)
+            for record in assembler.feed(delta):
+                if on_record:
+                    on_record(record.text())
+    except CompletionError as error:
+        on_error("Error", str(error))
+        return
+    if cancel_event is not None and cancel_event.is_set():
+        return
+    for record in assembler.flush():
+        if on_record:
+            on_record(record.text())
+
+    # Check every candidate in-process (repairing what we can) and keep the best before spending a Pd launch on it
+    ranked = rank_candidates(["".join(chunks[choice_index]) for choice_index in sorted(chunks)])
+    if not ranked or not ranked[0][2].ok:
+        errors = ranked[0][2].errors if ranked else ["No patch was returned"]
+        on_error("Error", "Generated patch is not valid Pure Data:\n" + "\n".join(errors[:10]))
+        return
+    validation = ranked[0][2]
+    for repair in validation.repairs:
+        print(f"Repaired generated patch: {repair}")
+    if cache is not None and not cached:
+        cache.put(data, [result.text for _, _, result in ranked if result.ok])
 
     # Create a folder for the .pd files if it doesn't exist
     os.makedirs(save_path, exist_ok=True)
@@ -79,32 +109,67 @@ def generate_start(prompt, api_key, temperature, random_word, save_path=os.path.
     # Create the .pd file in the chosen path
     pd_file_path = os.path.join(save_path, "GeneratedPureData.pd")
 
-    # Write the generated code to the .pd file
+    # Write the generated code to the .pd file, with any other valid candidates next to it as alternates
     with open(pd_file_path, "w") as pd_file:
-        pd_file.write(generated_text)
-
-    # Open the .pd file with the Pure Data application
+        pd_file.write(validation.text.rstrip())
+    for file in os.listdir(save_path):
+        if file.startswith("GeneratedPureData-alt") and file.endswith(".pd"):
+            os.remove(os.path.join(save_path, file))
+    alternates = [result for _, _, result in ranked[1:] if result.ok]
+    for number, result in enumerate(alternates, 1):
+        with open(os.path.join(save_path, f"GeneratedPureData-alt{number}.pd"), "w") as pd_file:
+            pd_file.write(result.text.rstrip())
+    if candidates > 1:
+        print(f"Picked candidate {ranked[0][1] + 1} of {len(ranked)} (score {ranked[0][0]:.1f}); "
+              f"{len(alternates)} alternate(s) saved")
+
+    # Open the .pd file in the running Pd session, replacing the last generated patch
+    pd_path = get_pd_path()
     if pd_path is not None:
-        subprocess.Popen([pd_path, pd_file_path])
+        session = get_pd_session(pd_path)
+        try:
+            # Once the session has failed to start this raises at once, so later
+            # clicks go straight to a new Pd instead of waiting out the timeout
+            session.open_patch(pd_file_path)
+        except OSError as error:
+            print(f"Pd session unavailable ({error}); opening the patch in a new Pd")
+            session.close()
+            subprocess.Popen([pd_path, pd_file_path])
     else:
-        QMessageBox.critical(None, "Error", "Pure Data executable not found")
+        on_error("Error", "Pure Data executable not found")
 
 class GeneratePDThread(QThread):
-    def __init__(self, prompt, api_key, temperature, save_path):
+    record_parsed = pyqtSignal(str)
+    # (title, message) of a failure, shown by the window on the GUI thread
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, prompt, api_key, temperature, save_path, use_cache=True, candidates=1, cache_sampled=False):
         super().__init__()
         self.prompt = prompt
         self.api_key = api_key
         self.temperature = temperature
         self.save_path = save_path
+        self.use_cache = use_cache
+        self.candidates = candidates
+        self.cache_sampled = cache_sampled
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
 
     def run(self):
-        generate_start(self.prompt, self.api_key, self.temperature, self.save_path)
+        generate_start(self.prompt, self.api_key, self.temperature, False, self.save_path,
+                       on_record=self.record_parsed.emit, cancel_event=self.cancel_event, use_cache=self.use_cache,
+                       candidates=self.candidates, on_error=self.failed.emit, cache_sampled=self.cache_sampled)
 
 
 class PureDataCodeGenerator(QMainWindow):
     def __init__(self):
         super().__init__()
         self.save_path = os.path.join(os.path.expanduser("~"), "Documents", "PureDataGPTpatches")
+        self.bypass_cache = False
+        self.cache_sampled = False
+        self.candidates = 1
         self.init_ui()
 
     def init_ui(self):
@@ -217,6 +282,31 @@ class PureDataCodeGenerator(QMainWindow):
         vbox.addWidget(save_path_entry)
         vbox.addWidget(browse_button)
 
+        bypass_cache_checkbox = QCheckBox("Bypass response cache")
+        bypass_cache_checkbox.setFont(font)
+        bypass_cache_checkbox.setChecked(self.bypass_cache)
+        bypass_cache_checkbox.setToolTip("Always request a fresh patch instead of reusing a cached one for the same prompt and temperature")
+        bypass_cache_checkbox.toggled.connect(lambda checked: setattr(self, "bypass_cache", checked))
+        vbox.addWidget(bypass_cache_checkbox)
+
+        cache_sampled_checkbox = QCheckBox("Cache sampled generations")
+        cache_sampled_checkbox.setFont(font)
+        cache_sampled_checkbox.setChecked(self.cache_sampled)
+        cache_sampled_checkbox.setToolTip("Also reuse cached patches when the temperature is above 0; otherwise only temperature-0 requests are cached and every click samples a new patch")
+        cache_sampled_checkbox.toggled.connect(lambda checked: setattr(self, "cache_sampled", checked))
+        vbox.addWidget(cache_sampled_checkbox)
+
+        candidates_label = QLabel("Candidates per generation:")
+        candidates_label.setFont(font)
+        candidates_spinbox = QSpinBox()
+        candidates_spinbox.setFont(font)
+        candidates_spinbox.setRange(1, 5)
+        candidates_spinbox.setValue(self.candidates)
+        candidates_spinbox.setToolTip("Request several patches in one call and open the best one; the others are saved as GeneratedPureData-alt*.pd")
+        candidates_spinbox.valueChanged.connect(lambda value: setattr(self, "candidates", value))
+        vbox.addWidget(candidates_label)
+        vbox.addWidget(candidates_spinbox)
+
         settings_dialog.setLayout(vbox)
         settings_dialog.exec_()
 
@@ -234,7 +324,7 @@ class PureDataCodeGenerator(QMainWindow):
     def add_random_term(self):
         random_terms = [get_random_term() for _ in range(5)]
         formatted_terms = ", ".join(random_terms)
-        self.prompt_entry.setText(f"{self.prompt_entry.text()} {formatted_terms}")
+        self.prompt_entry.setPlainText(f"{self.prompt_entry.toPlainText()} {formatted_terms}")
 
 
     def generate_pd(self):
@@ -250,31 +340,48 @@ class PureDataCodeGenerator(QMainWindow):
         self.loading_progress.setRange(0, 0)
         vbox.addWidget(self.loading_progress)
 
+        # Records of the patch appear here as they stream in
+        self.live_patch = QPlainTextEdit()
+        self.live_patch.setReadOnly(True)
+        self.live_patch.setMinimumSize(500, 200)
+        vbox.addWidget(self.live_patch)
+
+        cancel_button = QPushButton("Cancel")
+        vbox.addWidget(cancel_button)
+
         self.loading_dialog.setLayout(vbox)
 
         self.update_witty_message()
         self.loading_dialog.show()
 
-        prompt = self.prompt_entry.text()
+        prompt = self.prompt_entry.toPlainText()
         api_key = self.api_key_entry.text()
         temperature = self.temperature_slider.value() / 100
         save_path = self.save_path_entry.text() or self.save_path
 
-        self.generate_pd_thread = GeneratePDThread(prompt, api_key, temperature, save_path)
+        self.generate_pd_thread = GeneratePDThread(prompt, api_key, temperature, save_path, use_cache=not self.bypass_cache,
+                                                   candidates=self.candidates, cache_sampled=self.cache_sampled)
+        self.generate_pd_thread.record_parsed.connect(lambda record: self.live_patch.appendPlainText(record.strip()))
+        self.generate_pd_thread.failed.connect(self.show_generation_error)
         self.generate_pd_thread.finished.connect(self.loading_dialog.close)
+        cancel_button.clicked.connect(self.generate_pd_thread.cancel)
+        self.loading_dialog.rejected.connect(self.generate_pd_thread.cancel)
         self.generate_pd_thread.start()
 
+    def show_generation_error(self, title, message):
+        QMessageBox.warning(self, title, message)
+
     def update_witty_message(self):
         self.loading_message.setText(generate_witty_message())
         QTimer.singleShot(random.randint(3000, 5000), self.update_witty_message)
 
     def generate_pd_worker(self):
-        prompt = self.prompt_entry.text()
+        prompt = self.prompt_entry.toPlainText()
         api_key = self.api_key_entry.text()
         temperature = self.temperature_slider.value() / 100
         save_path = self.save_path_entry.text() or self.save_path
 
-        generate_start(prompt, api_key, temperature, save_path)
+        generate_start(prompt, api_key, temperature, False, save_path)
         self.loading_dialog.close()
 
     def save_api_key(self, api_key):
@@ -289,14 +396,14 @@ class PureDataCodeGenerator(QMainWindow):
         key = self.generate_key_from_password(password, salt)
         encrypted_api_key = self.encrypt_data(api_key.encode(), key)
 
-        with open("api_key.txt", "wb") as api_key_file:
+        with open(API_KEY_PATH, "wb") as api_key_file:
             api_key_file.write(salt + encrypted_api_key)
 
         QMessageBox.information(self, "Success", "API key saved and encrypted!")
 
     def load_api_key(self):
         try:
-            with open("api_key.txt", "rb") as api_key_file:
+            with open(API_KEY_PATH, "rb") as api_key_file:
                 data = api_key_file.read()
                 salt = data[:16]
                 encrypted_api_key = data[16:]
@@ -314,40 +421,40 @@ class PureDataCodeGenerator(QMainWindow):
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Failed to decrypt the API key: {str(e)}")
     
+    # cryptography is imported only when a key is saved or loaded, keeping it off the startup path
     def generate_key_from_password(self, password, salt):
+        from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
         kdf = Scrypt(salt=salt, length=32, n=2**14, r=8, p=1)
         key = base64.urlsafe_b64encode(kdf.derive(password))
         return key
 
     def encrypt_data(self, data, key):
+        from cryptography.fernet import Fernet
+
         fernet = Fernet(key)
         return fernet.encrypt(data)
 
     def decrypt_data(self, encrypted_data, key):
+        from cryptography.fernet import Fernet
+
         fernet = Fernet(key)
         return fernet.decrypt(encrypted_data)
 
 
-with open("randomPrompts.json", "r") as f:
-    terms_json = json.load(f)
-
-terms = terms_json["randomPrompts"]
-
 def get_random_term():
-    return random.choice(terms)
-
-def load_witty_messages_from_json():
-    with open("witty_loading_phases.json", "r") as file:
-        data = json.load(file)
-        return data["witty_messages"]
+    return random.choice(random_prompts())
 
 def generate_witty_message():
-    witty_messages = load_witty_messages_from_json()
-    return random.choice(witty_messages)
+    return random.choice(witty_messages())
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = PureDataCodeGenerator()
     window.show()
-    sys.exit(app.exec_())
\ No newline at end of file
+    with profiling(PROFILER, PROFILE_PATH):
+        status = app.exec_()
+    if METRICS_PATH is not None:
+        metrics.export(METRICS_PATH)
+    sys.exit(status)
\ No newline at end of file
@@ -0,0 +1,23 @@
+import os
+import sys
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from stub_api import StubAPI
+
+# Start a stub API with stub_api(respond); every server is stopped after the test
+@pytest.fixture
+def stub_api():
+    servers = []
+
+    def start(respond):
+        server = StubAPI(respond)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,81 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PATCH = "#N canvas 0 50 450 300 12;\n#X obj 10 10 osc~ 440;\n#X obj 10 40 dac~;\n#X connect 0 0 1 0;\n"
+
+def completion_body(*contents):
+    return json.dumps({
+        "choices": [{"index": index, "message": {"content": content}} for index, content in enumerate(contents)],
+        "usage": {"total_tokens": 10},
+    }).encode("utf-8")
+
+def sse_event(payload):
+    return f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8")
+
+def delta_event(text, index=0):
+    return sse_event({"choices": [{"index": index, "delta": {"content": text}}]})
+
+# A local stand-in for the chat completions endpoint. respond(request) gets the
+# decoded JSON request and returns (status, headers, body): bytes are sent with
+# a Content-Length, any other iterable of bytes is streamed in chunks. Every
+# request, the client connections seen and the peak number of requests in
+# flight are recorded
+class StubAPI:
+    def __init__(self, respond):
+        self.respond = respond
+        self.lock = threading.Lock()
+        self.requests = []
+        self.peers = set()
+        self.active = 0
+        self.max_active = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub.lock:
+                    stub.requests.append(request)
+                    stub.peers.add(self.client_address)
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    status, headers, body = stub.respond(request)
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    if isinstance(body, bytes):
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                    else:
+                        self.send_header("Transfer-Encoding", "chunked")
+                        self.end_headers()
+                        for chunk in body:
+                            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                            self.wfile.flush()
+                        self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # The user prompt of a request, as build_messages places it
+    @staticmethod
+    def prompt(request):
+        return request["messages"][-3]["content"].rsplit(": ", 1)[-1]
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import asyncio
+import threading
+
+from pd_batch import BatchGenerator, RateLimiter, open_unique
+from stub_api import PATCH, StubAPI, completion_body
+
+def run_batch(stub, tmp_path, prompts, **options):
+    generator = BatchGenerator("test-key", str(tmp_path / "patches"), endpoint=stub.url, backoff=0.01, **options)
+    results_path = tmp_path / "results.jsonl"
+    with generator.client:
+        results = asyncio.run(generator.run(prompts, str(results_path)))
+    return {result["prompt"]: result for result in results}, results_path
+
+def test_concurrency_is_bounded(stub_api, tmp_path):
+    def respond(request):
+        time.sleep(0.2)
+        return 200, {}, completion_body(PATCH)
+
+    stub = stub_api(respond)
+    results, _ = run_batch(stub, tmp_path, [f"tone {index}" for index in range(9)], concurrency=3)
+    assert stub.max_active == 3
+    assert all(result["valid"] for result in results.values())
+
+def test_concurrency_is_not_capped_by_the_default_executor(stub_api, tmp_path):
+    def respond(request):
+        time.sleep(0.3)
+        return 200, {}, completion_body(PATCH)
+
+    count = min(32, (os.cpu_count() or 1) + 4) + 4
+    stub = stub_api(respond)
+    run_batch(stub, tmp_path, [f"tone {index}" for index in range(count)], concurrency=count)
+    assert stub.max_active == count
+
+def test_retry_after_delays_the_retry(stub_api, tmp_path):
+    times = []
+
+    def respond(request):
+        times.append(time.monotonic())
+        if len(times) == 1:
+            return 429, {"retry-after": "0.3"}, b"slow down"
+        return 200, {}, completion_body(PATCH)
+
+    stub = stub_api(respond)
+    results, _ = run_batch(stub, tmp_path, ["tone"], concurrency=1)
+    assert results["tone"]["valid"]
+    assert len(times) == 2
+    assert times[1] - times[0] >= 0.3
+
+def test_exhausted_request_budget_pauses_the_next_request(stub_api, tmp_path):
+    times = []
+
+    def respond(request):
+        times.append(time.monotonic())
+        headers = {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "300ms"} if len(times) == 1 else {}
+        return 200, headers, completion_body(PATCH)
+
+    stub = stub_api(respond)
+    run_batch(stub, tmp_path, ["first", "second"], concurrency=1)
+    assert len(times) == 2
+    assert times[1] - times[0] >= 0.3
+
+def test_rate_limiter_reads_token_budget():
+    limiter = RateLimiter(min_remaining_tokens=100)
+    limiter.update({"x-ratelimit-remaining-tokens": "500", "x-ratelimit-reset-tokens": "5s"})
+    assert limiter.blocked_until == 0.0
+    limiter.update({"x-ratelimit-remaining-tokens": "50", "x-ratelimit-reset-tokens": "1m30s"})
+    assert limiter.blocked_until - time.monotonic() > 89
+
+def test_client_error_is_not_retried(stub_api, tmp_path):
+    stub = stub_api(lambda request: (400, {}, b"bad request"))
+    results, _ = run_batch(stub, tmp_path, ["tone"], max_retries=3)
+    assert len(stub.requests) == 1
+    assert results["tone"]["error"] == "400 - bad request"
+
+def test_server_error_is_retried_until_the_budget_runs_out(stub_api, tmp_path):
+    stub = stub_api(lambda request: (503, {}, b"unavailable"))
+    results, _ = run_batch(stub, tmp_path, ["tone"], max_retries=2)
+    assert len(stub.requests) == 3
+    assert results["tone"]["error"] == "503 - unavailable"
+
+def test_failures_are_isolated_per_prompt(stub_api, tmp_path):
+    responses = {
+        "ok": (200, {}, completion_body(PATCH)),
+        "rejected": (400, {}, b"bad request"),
+        "empty": (200, {}, json.dumps({"choices": []}).encode()),
+        "garbled": (200, {}, b"<html>not json</html>"),
+        "malformed": (200, {}, json.dumps({"choices": [{"index": 0}]}).encode()),
+    }
+    stub = stub_api(lambda request: responses[StubAPI.prompt(request)])
+    results, results_path = run_batch(stub, tmp_path, list(responses))
+
+    assert results["ok"]["valid"] and os.path.exists(results["ok"]["path"])
+    assert results["rejected"]["error"] == "400 - bad request"
+    assert results["empty"]["error"] == "No choices in response"
+    assert results["garbled"]["error"].startswith("Invalid JSON in response")
+    assert results["malformed"]["error"].startswith("KeyError")
+    lines = [json.loads(line) for line in results_path.read_text().splitlines()]
+    assert sorted(line["prompt"] for line in lines) == sorted(responses)
+
+def test_open_unique_under_concurrent_workers(tmp_path):
+    barrier = threading.Barrier(16)
+    paths = []
+
+    def claim():
+        barrier.wait()
+        path, file = open_unique(str(tmp_path), "00000-tone")
+        with file:
+            file.write(path)
+        paths.append(path)
+
+    workers = [threading.Thread(target=claim) for _ in range(16)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(set(paths)) == 16
+    assert all(open(path).read() == path for path in paths)
+
+def test_reruns_do_not_overwrite_earlier_patches(stub_api, tmp_path):
+    stub = stub_api(lambda request: (200, {}, completion_body(PATCH)))
+    first, _ = run_batch(stub, tmp_path, ["tone"])
+    second, _ = run_batch(stub, tmp_path, ["tone"])
+    assert first["tone"]["path"] != second["tone"]["path"]
+    assert second["tone"]["path"].endswith("00000-tone-1.pd")
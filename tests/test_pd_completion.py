@@ -0,0 +1,88 @@
+import time
+import threading
+
+import pytest
+
+from pd_completion import CompletionClient, CompletionError, build_request_data
+from stub_api import PATCH, completion_body, delta_event, sse_event
+
+DATA = build_request_data("tone", 0)
+
+def client_for(stub, **options):
+    return CompletionClient("test-key", stub.url, http2=False, **options)
+
+def events(*chunks, delay=0.0):
+    for chunk in chunks:
+        if delay:
+            time.sleep(delay)
+        yield chunk
+
+def test_stream_yields_deltas_until_done(stub_api):
+    stub = stub_api(lambda request: (200, {"Content-Type": "text/event-stream"}, events(
+        b": keep-alive\n\n", delta_event("#N canvas"), delta_event(" 0 50", index=1), sse_event("[DONE]"),
+        delta_event("after done"))))
+    with client_for(stub) as client:
+        assert list(client.stream(DATA)) == [(0, "#N canvas"), (1, " 0 50")]
+    assert stub.requests[0]["stream"] is True
+
+def test_stalled_stream_raises_within_read_timeout(stub_api):
+    release = threading.Event()
+
+    def stalled():
+        yield delta_event("#N")
+        release.wait(10)
+
+    stub = stub_api(lambda request: (200, {}, stalled()))
+    try:
+        with client_for(stub, read_timeout=0.3) as client:
+            started = time.monotonic()
+            received = []
+            with pytest.raises(CompletionError):
+                for delta in client.stream(DATA):
+                    received.append(delta)
+            assert time.monotonic() - started < 3
+            assert received == [(0, "#N")]
+    finally:
+        release.set()
+
+def test_cancel_stops_the_stream_and_closes_the_connection(stub_api):
+    cancel = threading.Event()
+    stub = stub_api(lambda request: (200, {}, events(*(delta_event("x") for _ in range(200)), delay=0.02)))
+    with client_for(stub) as client:
+        received = []
+        for delta in client.stream(DATA, cancel_event=cancel):
+            received.append(delta)
+            cancel.set()
+        assert received == [(0, "x")]
+        deadline = time.monotonic() + 2
+        while stub.active and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert stub.active == 0
+
+def test_malformed_event_raises(stub_api):
+    stub = stub_api(lambda request: (200, {}, events(delta_event("#N"), b"data: {\"choices\": [\n\n")))
+    with client_for(stub) as client:
+        with pytest.raises(CompletionError, match="malformed stream event"):
+            list(client.stream(DATA))
+
+def test_error_status_raises(stub_api):
+    stub = stub_api(lambda request: (500, {}, b"overloaded"))
+    with client_for(stub) as client:
+        with pytest.raises(CompletionError, match="500 - overloaded"):
+            list(client.stream(DATA))
+
+def test_requests_reuse_one_connection_and_record_latency(stub_api):
+    statuses = iter([200, 200, 200, 500])
+    stub = stub_api(lambda request: (next(statuses), {}, completion_body(PATCH)))
+    with client_for(stub) as client:
+        for _ in range(3):
+            body, error = client.complete(DATA)
+            assert error is None and body["choices"][0]["message"]["content"] == PATCH
+        body, error = client.complete(DATA)
+        assert body is None and error.startswith("Error generating Pure Data code: 500")
+        summary = client.metrics.summary()
+    assert len(stub.peers) == 1
+    assert summary["requests"] == 4
+    assert summary["errors"] == 1
+    assert summary["http_versions"] == ["HTTP/1.1"]
+    assert summary["first_byte_p50"] <= summary["total_p50"]
@@ -0,0 +1,40 @@
+from pd_normalize import array_values, normalize_patch, same_patch
+from pd_parser import parse
+
+DELAY_PATCH = """#N canvas 12 34 600 400 10;
+#X obj 103 207 delwrite~ buf 100;
+#X obj 47 101 delread~ buf 10;
+#X obj 47 151 dac~;
+#X obj 103 151 osc~ 440;
+#X connect 1 0 2 0;
+#X connect 3 0 0 0;
+"""
+
+ARRAY_PATCH = """#N canvas 0 50 450 300 10;
+#N canvas 0 50 450 250 (subpatch) 0;
+#X array table 16 float 3;
+#A 0 0 0 0 0.5 0 0 0 0 0 0 0 -0.25 0 0 0 0;
+#X coords 0 1 15 -1 200 140 1;
+#X restore 20 20 graph;
+"""
+
+def test_unconnected_objects_keep_their_order():
+    names = [obj.name for obj in parse(normalize_patch(DELAY_PATCH)).root.objects]
+    assert names.index("delwrite~") < names.index("delread~")
+
+def test_normalize_is_idempotent():
+    normalized = normalize_patch(DELAY_PATCH)
+    assert normalized != DELAY_PATCH
+    assert normalize_patch(normalized) == normalized
+
+def test_array_zeros_are_left_out():
+    normalized = normalize_patch(ARRAY_PATCH)
+    assert "#A 3 0.5;" in normalized and "#A 11 -0.25;" in normalized
+    assert same_patch(ARRAY_PATCH, normalized)
+    array = next(obj for obj in parse(normalized).iter_objects() if obj.kind == "array")
+    assert array_values(array) == {3: "0.5", 11: "-0.25"}
+
+def test_scale_writes_grid_units():
+    normalized = normalize_patch(DELAY_PATCH, scale=True)
+    positions = [obj.position for obj in parse(normalized).root.objects]
+    assert max(x for x, _ in positions) <= 6 and max(y for _, y in positions) <= 11
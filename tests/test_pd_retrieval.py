@@ -0,0 +1,12 @@
+import json
+
+from pd_retrieval import iter_jsonl_documents
+
+def test_jsonl_titles_drop_prefix_and_separator(tmp_path):
+    path = tmp_path / "patches.jsonl"
+    records = [
+        {"prompt": "PureData Patch: sine tone", "completion": "#N canvas 0 50 450 300 12;\n"},
+        {"prompt": "engine002 ->", "completion": " #N canvas 0 50 450 300 12;\n"},
+    ]
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    assert [title for title, _ in iter_jsonl_documents(str(path))] == ["sine tone", "engine002"]
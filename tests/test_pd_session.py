@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import socket
+import threading
+
+import pytest
+
+from pd_session import PdSession, fudi_message, free_port
+
+# Stands in for Pd: listens on the control patch's [netreceive] port and exits
+# cleanly once it is sent quit
+FAKE_PD = """#!{python}
+import re, sys, socket
+control = open(sys.argv[sys.argv.index("-open") + 1]).read()
+port = int(re.search(r"netreceive (\\d+)", control).group(1))
+with socket.create_server(("127.0.0.1", port)) as server:
+    connection, _ = server.accept()
+    received = b""
+    while not received.endswith(b"quit;\\n"):
+        chunk = connection.recv(4096)
+        if not chunk:
+            sys.exit(1)
+        received += chunk
+"""
+
+# Accept one connection on a free port and collect everything sent over it until it closes
+class FudiListener:
+    def __init__(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.received = b""
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+
+    def listen(self):
+        connection, _ = self.server.accept()
+        with connection:
+            while chunk := connection.recv(4096):
+                self.received += chunk
+        self.server.close()
+
+    def messages(self):
+        self.thread.join(2)
+        return self.received.decode("utf-8")
+
+def test_fudi_message_escapes_separators():
+    assert fudi_message("open", "a,b $1 c;d.pd", "/tmp/my dir") == "open a\\,b\\ \\$1\\ c\\;d.pd /tmp/my\\ dir;\n"
+    assert fudi_message("dsp", 1) == "dsp 1;\n"
+
+def test_session_sends_open_close_and_dsp(tmp_path):
+    listener = FudiListener()
+    first = tmp_path / "first patch.pd"
+    second = tmp_path / "second;patch.pd"
+    with PdSession(None, port=listener.port) as session:
+        session.open_patch(str(first))
+        session.dsp(True)
+        session.open_patch(str(second))
+        session.close_patch()
+        session.dsp(False)
+    directory = str(tmp_path).replace(" ", "\\ ")
+    assert listener.messages() == (
+        f"open first\\ patch.pd {directory};\n"
+        "dsp 1;\n"
+        "close symbol first\\ patch.pd;\n"
+        f"open second\\;patch.pd {directory};\n"
+        "close symbol second\\;patch.pd;\n"
+        "dsp 0;\n"
+    )
+
+def test_close_quits_pd_and_removes_the_control_patch(tmp_path):
+    pd_path = tmp_path / "pd"
+    pd_path.write_text(FAKE_PD.format(python=sys.executable))
+    pd_path.chmod(0o755)
+    session = PdSession(str(pd_path), gui=False)
+    session.start()
+    control_dir = session.control_dir
+    assert os.path.exists(os.path.join(control_dir, "session-control.pd"))
+    process = session.process
+    session.dsp(True)
+    session.close()
+    assert process.returncode == 0
+    assert not os.path.exists(control_dir)
+
+def test_failed_start_is_remembered(tmp_path):
+    pd_path = tmp_path / "pd"
+    pd_path.write_text(f"#!{sys.executable}\nimport sys\nsys.exit(3)\n")
+    pd_path.chmod(0o755)
+    session = PdSession(str(pd_path), connect_timeout=5)
+    with pytest.raises(ConnectionError, match="status 3"):
+        session.start()
+    assert session.process is None and session.control_dir is None
+
+    started = time.monotonic()
+    with pytest.raises(ConnectionError, match="failed to start earlier"):
+        session.open_patch(str(tmp_path / "patch.pd"))
+    assert time.monotonic() - started < 0.5
+
+def test_unreachable_session_is_not_retried():
+    session = PdSession(None, port=free_port(), connect_timeout=0.2)
+    with pytest.raises(ConnectionError, match="did not accept commands"):
+        session.start()
+    started = time.monotonic()
+    with pytest.raises(ConnectionError):
+        session.dsp(True)
+    assert time.monotonic() - started < 0.1
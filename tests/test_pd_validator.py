@@ -0,0 +1,19 @@
+from pd_validator import repair_patch, validate_patch
+
+TEXT_OBJECTS = """#N canvas 0 50 450 300 12;
+#X obj 10 10 text define -k foo;
+#X obj 10 40 print;
+#X msg 100 10 0;
+#X obj 100 40 text get foo;
+#X connect 0 0 1 0;
+#X connect 2 0 3 0;
+#X connect 3 0 1 0;
+"""
+
+def test_text_objects_are_not_treated_as_comments():
+    assert validate_patch(TEXT_OBJECTS).errors == []
+    assert repair_patch(TEXT_OBJECTS)[1] == []
+
+def test_comments_have_no_ports():
+    patch = "#N canvas 0 50 450 300 12;\n#X text 10 10 a comment;\n#X obj 10 40 print;\n#X connect 0 0 1 0;\n"
+    assert validate_patch(patch).errors == ["connect 0 0 1 0: text has 0 outlet(s)"]